@@ -0,0 +1,157 @@
+import datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# datetime64 counts days from 1970-01-01, date ordinals from 0001-01-01
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+FEB_29_SLOT = 59
+AGE_BUCKET = 10
+
+
+class BirthdayColumns:
+    # columnar copy of the book's birthdays: one row per contact with a
+    # birthday, so window and aggregate queries run as NumPy array operations
+    # instead of a datetime.date per contact. Rows are built in key order;
+    # the book listeners tombstone the row of a contact whose birthday
+    # changes and queue the contact as a new row at the end. Once a quarter
+    # of the rows are tombstones the next query rebuilds the columns
+    def __init__(self, book):
+        if np is None:
+            raise ImportError('Birthday analytics need NumPy: pip install numpy')
+        self.book = book
+        self.stale = True
+        book.listeners.append(self.on_change)
+
+    def on_change(self, key, record):
+        if self.stale:
+            return
+        birthday = 0 if record is None else record._birthday
+        row = self.rows.get(key)
+        if row is not None:
+            if birthday == self.ordinal[row]:
+                self.row_records[row] = record
+                return
+            del self.rows[key]
+            self.live[row] = False
+            self.dead += 1
+            if self.dead * 4 > len(self.row_records):
+                self.stale = True
+                return
+        if birthday:
+            self.appended[key] = record
+        else:
+            self.appended.pop(key, None)
+
+    def refresh(self):
+        if self.stale:
+            self.rebuild()
+        elif self.appended:
+            self.append_rows()
+
+    def rebuild(self):
+        self.book.materialize()
+        keys = self.book._ordered_keys()
+        data = self.book.data
+        ordinals = np.fromiter((data[key]._birthday for key in keys), dtype=np.int64, count=len(keys))
+        rows = np.flatnonzero(ordinals)
+        self.keys = [keys[row] for row in rows.tolist()]
+        self.rows = {key: row for row, key in enumerate(self.keys)}
+        self.row_records = [data[key] for key in self.keys]
+        self.ordinal = ordinals[rows]
+        self.year, self.month, self.day, self.slot = self.columns(self.ordinal)
+        self.live = np.ones(len(self.keys), dtype=bool)
+        self.dead = 0
+        self.appended = {}
+        self.in_key_order = True
+        self.stale = False
+
+    def append_rows(self):
+        start = len(self.keys)
+        for offset, key in enumerate(self.appended):
+            self.rows[key] = start + offset
+        self.keys.extend(self.appended)
+        self.row_records.extend(self.appended.values())
+        ordinals = np.fromiter((record._birthday for record in self.appended.values()),
+                               dtype=np.int64, count=len(self.appended))
+        self.ordinal = np.concatenate((self.ordinal, ordinals))
+        columns = zip((self.year, self.month, self.day, self.slot), self.columns(ordinals))
+        self.year, self.month, self.day, self.slot = (np.concatenate(pair) for pair in columns)
+        self.live = np.concatenate((self.live, np.ones(len(ordinals), dtype=bool)))
+        self.appended = {}
+        self.in_key_order = False
+
+    @staticmethod
+    def columns(ordinals):
+        dates = (ordinals - EPOCH_ORDINAL).astype('datetime64[D]')
+        years = dates.astype('datetime64[Y]')
+        months = dates.astype('datetime64[M]')
+        year = years.astype(np.int64) + 1970
+        month = (months - years).astype(np.int64) + 1
+        day = (dates - months).astype(np.int64) + 1
+        # day of a leap year, as in classes.birthday_slot
+        slot = (dates - years).astype(np.int64)
+        leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+        slot[~leap & (slot >= FEB_29_SLOT)] += 1
+        return year, month, day, slot
+
+    def records(self, positions):
+        row_records = self.row_records
+        return [row_records[position] for position in positions.tolist()]
+
+    def ordered(self, positions, values):
+        # positions sorted by values, then key. A stable sort keeps key order
+        # while the rows are in it; appended rows need the keys compared
+        if self.in_key_order:
+            return positions[np.argsort(values, kind='stable')]
+        keys = np.array([self.keys[position] for position in positions.tolist()], dtype=str)
+        return positions[np.lexsort((keys, values))]
+
+    @staticmethod
+    def day_in_year(slot, year):
+        # Feb 29 birthdays fall on Feb 28 in common years, like birthday_in_year
+        if datetime.date(year, 12, 31).timetuple().tm_yday == 366:
+            return slot
+        return slot - (slot >= FEB_29_SLOT)
+
+    def days_until(self, today):
+        today_day = today.timetuple().tm_yday - 1
+        year_length = datetime.date(today.year, 12, 31).timetuple().tm_yday
+        this_year = self.day_in_year(self.slot, today.year) - today_day
+        next_year = self.day_in_year(self.slot, today.year + 1) + year_length - today_day
+        return np.where(this_year >= 0, this_year, next_year)
+
+    def upcoming(self, days, today=None):
+        # the records of AddressBook.upcoming_birthdays: date order, then key
+        today = today or datetime.date.today()
+        self.refresh()
+        until = self.days_until(today)
+        positions = np.flatnonzero(self.live & (until < min(days, 366)))
+        return self.records(self.ordered(positions, until[positions]))
+
+    def per_month(self):
+        self.refresh()
+        return np.bincount(self.month[self.live], minlength=13)[1:].tolist()
+
+    def ages(self, today=None):
+        today = today or datetime.date.today()
+        self.refresh()
+        today_slot = today.timetuple().tm_yday - 1
+        had_birthday = self.day_in_year(self.slot, today.year) <= today_slot
+        return (today.year - self.year - (~had_birthday))[self.live]
+
+    def age_distribution(self, today=None):
+        # (first age of the bucket, contacts) for every bucket of AGE_BUCKET years
+        ages = self.ages(today)
+        ages = ages[ages >= 0]
+        counts = np.bincount(ages // AGE_BUCKET)
+        return [(bucket * AGE_BUCKET, int(count)) for bucket, count in enumerate(counts) if count]
+
+    def turning(self, age, year=None):
+        # contacts who turn `age` in `year`, in birthday order
+        year = year or datetime.date.today().year
+        self.refresh()
+        positions = np.flatnonzero(self.live & (self.year == year - age))
+        return self.records(self.ordered(positions, self.slot[positions]))
@@ -1,12 +1,209 @@
-from flask import Flask
-from main import run
+import atexit
+import functools
+import os
+
+from flask import Flask, jsonify, request
+
+from bot import Bot
+from classes import Record
+from metrics import METRICS
+from rwlock import ReadWriteLock
 
 app = Flask(__name__)
 
+# CONSOLEBOT_METRICS=1 turns on the timings served at /metrics
+METRICS.enabled = os.environ.get('CONSOLEBOT_METRICS') == '1'
+
+# one book shared by every request; searches run side by side under the
+# read lock while edits (and their journal writes) take the write lock
+bot = Bot()
+book = bot.book
+notes = bot.notes
+lock = ReadWriteLock()
+book.prepare_reads()
+
+
+def close_books():
+    with lock.write():
+        bot.store.close()
+        bot.note_store.close()
+
+
+atexit.register(close_books)
+
+
+def reading(func):
+    @functools.wraps(func)
+    def inner(*args, **kwargs):
+        with lock.read():
+            return func(*args, **kwargs)
+    return inner
+
+
+def writing(func):
+    # a handler that raises leaves both books as they were
+    @functools.wraps(func)
+    def inner(*args, **kwargs):
+        with lock.write():
+            try:
+                with bot.transaction():
+                    return func(*args, **kwargs)
+            finally:
+                book.prepare_reads()
+    return inner
+
+
+def error(message, status):
+    return jsonify({"error": message}), status
+
+
+def json_body():
+    data = request.get_json(force=True)
+    if not isinstance(data, dict):
+        raise ValueError("The request body must be a JSON object")
+    return data
+
+
+def contact_name(value):
+    if not isinstance(value, str) or not value:
+        raise ValueError("name must be a non-empty string")
+    return value
+
+
+def contacts(records):
+    return jsonify([record.to_dict() for record in records])
+
+
+@app.errorhandler(ValueError)
+def invalid_value(e):
+    return error(str(e), 400)
+
+
 @app.route('/')
 def index():
-    run()
-    return "Hello, World!"
+    return jsonify({"contacts": len(book), "notes": len(notes)})
+
+
+@app.get('/contacts')
+@reading
+def list_contacts():
+    records, cursor = book.page(request.args.get('cursor'), request.args.get('page_size', type=int))
+    return jsonify({"contacts": [record.to_dict() for record in records], "next": cursor})
+
+
+@app.get('/contacts/search')
+@reading
+def search_contacts():
+    return contacts(book.search_contact(request.args.get('q', '')))
+
+
+@app.get('/contacts/phone/<phone>')
+@reading
+def search_phone(phone):
+    return contacts(book.search_phone(phone))
+
+
+@app.get('/contacts/birthdays')
+@reading
+def upcoming_birthdays():
+    return contacts(book.upcoming_birthdays(request.args.get('days', 7, type=int)))
+
+
+@app.get('/contacts/<name>')
+@reading
+def get_contact(name):
+    record = book.find(name)
+    if record is None:
+        return error("There is no contact with this name", 404)
+    return jsonify(record.to_dict())
+
+
+@app.post('/contacts')
+@writing
+def add_contact():
+    data = json_body()
+    contact_name(data.get("name"))
+    record = Record.from_dict(data)
+    book.add_record(record)
+    return jsonify(record.to_dict()), 201
+
+
+@app.post('/contacts/<name>/phones')
+@writing
+def add_phone(name):
+    record = book.find(name)
+    if record is None:
+        return error("There is no contact with this name", 404)
+    record.add_phone(json_body().get("phone"))
+    return jsonify(record.to_dict())
+
+
+@app.delete('/contacts/<name>/phones/<phone>')
+@writing
+def remove_phone(name, phone):
+    record = book.find(name)
+    if record is None:
+        return error("There is no contact with this name", 404)
+    record.remove_phone(phone)
+    return jsonify(record.to_dict())
+
+
+@app.post('/contacts/<name>/rename')
+@writing
+def rename_contact(name):
+    new_name = contact_name(json_body().get("name"))
+    if name not in book:
+        return error("There is no contact with this name", 404)
+    book.edit_record_name(name, new_name)
+    return jsonify(book.find(new_name).to_dict())
+
+
+@app.delete('/contacts/<name>')
+@writing
+def delete_contact(name):
+    if name not in book:
+        return error("There is no contact with this name", 404)
+    book.remove_record(name)
+    return '', 204
+
+
+@app.get('/notes')
+@reading
+def search_notes():
+    found = notes.search(request.args.get('q', ''))
+    return jsonify([{"title": title, "text": text} for title, text in found])
+
+
+@app.get('/metrics')
+def metrics():
+    return METRICS.prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+@app.post('/notes')
+@writing
+def add_note():
+    data = json_body()
+    if not data.get("title"):
+        return error("title is required", 400)
+    notes.add(data["title"], data.get("text", ""))
+    return jsonify({"title": data["title"], "text": notes[data["title"]]}), 201
+
+
+@app.put('/notes/<title>')
+@writing
+def edit_note(title):
+    if notes.edit(title, json_body().get("text", "")) is False:
+        return error("Note not found", 404)
+    return jsonify({"title": title, "text": notes[title]})
+
+
+@app.delete('/notes/<title>')
+@writing
+def remove_note(title):
+    if not notes.delete(title):
+        return error("Note not found", 404)
+    return '', 204
+
 
 if __name__ == '__main__':
-    app.run(host='0,0,0,0', debug=True)
+    app.run(host='0.0.0.0', threaded=True)
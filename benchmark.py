@@ -0,0 +1,313 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import pickle
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from classes import AddressBook, Record
+from notes import Note
+from sharding import ShardedAddressBook
+from storage import JournaledStore, RecordCodec
+
+
+class LegacyField:
+    # the dict-backed layout Record used before __slots__, kept for comparison
+    def __init__(self, value):
+        self.value = value
+
+
+class LegacyRecord:
+    def __init__(self, name, phones, birthday):
+        self._name = LegacyField(LegacyField(name))
+        self.phones = [LegacyField(phone) for phone in phones]
+        self._birthday = LegacyField(birthday) if birthday else None
+
+
+def synthetic_contacts(count, seed=0):
+    rng = random.Random(seed)
+    start = datetime.date(1950, 1, 1).toordinal()
+    for i in range(count):
+        name = f'contact{i}'
+        phones = ['%010d' % rng.randrange(10 ** 10) for _ in range(rng.randint(1, 3))]
+        birthday = datetime.date.fromordinal(start + rng.randrange(20000)) if rng.random() < 0.8 else None
+        yield name, phones, birthday
+
+
+def measure(build, count):
+    contacts = list(synthetic_contacts(count))
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    records = [build(*contact) for contact in contacts]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del records
+    return (after - before) / count
+
+
+def build_record(name, phones, birthday):
+    record = Record(name, birthday)
+    record.phones = phones
+    return record
+
+
+def measure_book(count):
+    # a whole book: the records plus the name, phone and birthday indexes
+    contacts = list(synthetic_contacts(count))
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    book = AddressBook()
+    for contact in contacts:
+        book.add_record(build_record(*contact))
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del book
+    return (after - before) / count
+
+
+def memory_benchmark(count):
+    legacy = measure(LegacyRecord, count)
+    compact = measure(build_record, count)
+    book = measure_book(count)
+    return {
+        "benchmark": "record_memory",
+        "size": count,
+        "legacy_bytes_per_contact": round(legacy, 1),
+        "compact_bytes_per_contact": round(compact, 1),
+        "ratio": round(legacy / compact, 2),
+        "book_bytes_per_contact": round(book, 1),
+    }
+
+
+def timed(name, size, func, repeat):
+    timings = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        func(i)
+        timings.append(time.perf_counter() - started)
+    return {
+        "benchmark": name,
+        "size": size,
+        "ops": repeat,
+        "mean_us": round(sum(timings) / repeat * 1e6, 2),
+        "min_us": round(min(timings) * 1e6, 2),
+    }
+
+
+def synthetic_book(count):
+    book = AddressBook()
+    for name, phones, birthday in synthetic_contacts(count):
+        book.add_record(build_record(name, phones, birthday))
+    return book
+
+
+def synthetic_notes(count, seed=0):
+    rng = random.Random(seed)
+    words = ['milk', 'eggs', 'bread', 'meeting', 'call', 'project', 'report', 'gift', 'trip', 'book']
+    notes = Note()
+    for i in range(count):
+        notes.add(f'note{i}', ' '.join(rng.choice(words) for _ in range(8)))
+    return notes
+
+
+def make_bot():
+    # Bot opens its books in the working directory, so it gets an empty one
+    from bot import Bot
+    with contextlib.redirect_stdout(io.StringIO()):
+        return Bot()
+
+
+def book_benchmarks(size, repeat):
+    results = []
+    contacts = list(synthetic_contacts(size))
+    started = time.perf_counter()
+    book = synthetic_book(size)
+    results.append({"benchmark": "build_book", "size": size, "ops": size,
+                    "mean_us": round((time.perf_counter() - started) / size * 1e6, 2)})
+    names = [contact[0] for contact in contacts]
+    phones = [contact[1][0] for contact in contacts]
+    rng = random.Random(1)
+
+    def add_record(i):
+        book.add_record(build_record(f'extra{size}_{i}', ['5550000000'], None))
+
+    results.append(timed('add_record', size, add_record, repeat))
+    results.append(timed('find', size, lambda i: book.find(rng.choice(names)), repeat))
+    results.append(timed('search_contact', size, lambda i: book.search_contact(f'act{rng.randrange(100)}'), repeat))
+    results.append(timed('search_phone', size, lambda i: book.search_phone(rng.choice(phones)), repeat))
+    # the same queries past the result cache
+    results.append(timed('search_contact_uncached', size,
+                         lambda i: book._search_contact(f'act{rng.randrange(100)}'), repeat))
+    results.append(timed('search_phone_uncached', size, lambda i: book._search_phone(rng.choice(phones)), repeat))
+    results.append(timed('paginate', size, lambda i: sum(1 for _ in book.paginate()), max(1, repeat // 100)))
+
+    bot = make_bot()
+    results.append(timed('contacts_birthday', size, lambda i: bot.contacts_birthday(book, [['7']]), repeat))
+    today = datetime.date.today()
+    results.append(timed('contacts_birthday_uncached', size, lambda i: book._upcoming_birthdays(7, today), repeat))
+    inputs = ['add phone denis 1234567890', 'search note milk', 'remove address denis kiev',
+              'contacts birthday 5', 'show all notes', 'edit name denis andrew']
+    results.append(timed('parser_dispatch', size,
+                         lambda i: bot.parser(inputs[i % len(inputs)]), repeat))
+    with contextlib.redirect_stdout(io.StringIO()):
+        bot.good_bye(bot.book, [])
+
+    notes = synthetic_notes(max(1, size // 10))
+    results.append(timed('search_note', size // 10, lambda i: notes.search('meeting'), max(1, repeat // 100)))
+    results.append(timed('search_note_uncached', size // 10, lambda i: notes._search('meeting', 10),
+                         max(1, repeat // 100)))
+
+    path = os.path.join(os.getcwd(), 'bench_book')
+
+    def pickle_save(i):
+        with open(path + '.pickle', 'wb') as fh:
+            pickle.dump(book.data, fh)
+
+    def pickle_load(i):
+        with open(path + '.pickle', 'rb') as fh:
+            AddressBook(pickle.load(fh))
+
+    results.append(timed('pickle_save', size, pickle_save, 1))
+    results.append(timed('pickle_load', size, pickle_load, 1))
+    results.append(timed('json_save', size, lambda i: book.save_to_file(path + '.json'), 1))
+    results.append(timed('json_load', size, lambda i: AddressBook().load_from_file(path + '.json'), 1))
+
+    codec = RecordCodec(Record.to_packed, Record.from_packed)
+
+    def binary_load(lazy):
+        loaded = AddressBook()
+        JournaledStore(path, loaded, Record.to_dict, Record.from_dict, codec=codec).load(lazy)
+        return loaded
+
+    store = JournaledStore(path, book, Record.to_dict, Record.from_dict, codec=codec)
+    results.append(timed('binary_save', size, lambda i: store.compact(), 1))
+    results.append(timed('binary_load', size, lambda i: binary_load(False), 1))
+    results.append(timed('binary_open_lazy', size, lambda i: binary_load(True), 1))
+    return results
+
+
+# run in a fresh interpreter, so the imports are timed cold
+STARTUP_SCRIPT = '''
+import contextlib, io, json, time
+started = time.perf_counter()
+from bot import Bot
+with contextlib.redirect_stdout(io.StringIO()):
+    bot = Bot()
+ready = time.perf_counter()
+bot.book, bot.notes
+loaded = time.perf_counter()
+bot.good_bye(bot.book, [])
+print(json.dumps([ready - started, loaded - started]))
+'''
+
+
+def startup_benchmark(size, repeat):
+    # time from importing the bot to the prompt, and to both books loaded,
+    # with a book of size contacts saved in the working directory
+    workdir = os.path.join(os.getcwd(), f'startup{size}')
+    os.makedirs(workdir, exist_ok=True)
+    book = synthetic_book(size)
+    JournaledStore(os.path.join(workdir, 'phone_book'), book, Record.to_dict, Record.from_dict,
+                   codec=RecordCodec(Record.to_packed, Record.from_packed)).compact()
+    notes = synthetic_notes(max(1, size // 10))
+    JournaledStore(os.path.join(workdir, 'note_book'), notes, str, str).compact()
+    del book, notes
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    timings = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], cwd=workdir, env=env,
+                                capture_output=True, text=True, check=True).stdout
+        timings.append(json.loads(output))
+    return {
+        "benchmark": "startup",
+        "size": size,
+        "runs": repeat,
+        "prompt_ms": round(sum(ready for ready, _ in timings) / repeat * 1000, 1),
+        "loaded_ms": round(sum(loaded for _, loaded in timings) / repeat * 1000, 1),
+    }
+
+
+def shard_benchmarks(size, shards, workers, repeat):
+    # the same queries on one sharded book, in-process (0 workers) and with
+    # worker processes; speedup is relative to the first worker count
+    path = os.path.join(os.getcwd(), f'bench_shards{size}')
+    book = ShardedAddressBook(path, shards)
+    for name, phones, birthday in synthetic_contacts(size):
+        book.add_record(build_record(name, phones, birthday))
+    book.compact()
+    book.close()
+    results = []
+    baseline = {}
+    for count in workers:
+        book = ShardedAddressBook(path, shards, count)
+        rng = random.Random(1)
+        # the workers load their replicas on the first query
+        book.search_contact('contact1')
+        book.upcoming_birthdays(7)
+        benchmarks = (
+            ('shard_search_contact', lambda i: book.search_contact(f'act{rng.randrange(100)}')),
+            # two characters are too short for the n-gram indexes, so this scans
+            ('shard_scan_contact', lambda i: book.search_contact(f'{rng.randrange(10, 100)}')),
+            ('shard_contacts_birthday', lambda i: book.upcoming_birthdays(7)),
+        )
+        for name, func in benchmarks:
+            result = timed(name, size, func, repeat)
+            result.update(shards=shards, workers=count)
+            baseline.setdefault(name, result['mean_us'])
+            result['speedup'] = round(baseline[name] / result['mean_us'], 2)
+            results.append(result)
+        book.close()
+    return results
+
+
+def run_suite(sizes, repeat, shards=0, workers=(0, 1, 2, 4)):
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            for size in sizes:
+                results.extend(book_benchmarks(size, repeat))
+                results.append(memory_benchmark(size))
+                results.append(startup_benchmark(size, 5))
+                if shards:
+                    results.extend(shard_benchmarks(size, shards, workers, max(1, repeat // 100)))
+        finally:
+            os.chdir(cwd)
+    return {
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ConsoleBot benchmarks')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='book sizes to benchmark, e.g. --sizes 1000 1000000')
+    parser.add_argument('--repeat', type=int, default=1000, help='operations timed per benchmark')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--shards', type=int, default=0,
+                        help='also benchmark a book split into this many shards')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4],
+                        help='worker process counts for the sharded searches (0 = in-process)')
+    args = parser.parse_args()
+    report = json.dumps(run_suite(args.sizes, args.repeat, args.shards, args.workers), indent=2)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,22 @@
+import calendar
+import contextlib
+import functools
+import io
 import pickle
+import re
+import os
+import sys
+import threading
+import time
 import typing
-from abc import ABC, abstractclassmethod
+from abc import ABC, abstractmethod
 from typing import List
-from .clean_folder import Cleaner
-from .classes import *
-from .exceptions import *
-from .notes import *
+from classes import *
+from exceptions import *
+from notes import *
+from storage import Autosaver, JournaledStore, RecordCodec
+from bulk import import_contacts, export_contacts
+from metrics import METRICS
 
 
 # from .clean_folder import Cleaner
@@ -20,7 +31,7 @@ TEXT = \
     1. Add contact with additional info:      - - - > add info name phone birthday email address (example: add info denis 1234567890 20.12.2012 goit@mail.com Kiev)
     2. Add phone                              - - - > add phone name phone_number (example: add phone denis 1234567890)
     3. Add address                            - - - > add address name address (example: add address denis Kiev)
-    4. Add note                               - - - > add note title text (example: add note shopping_list "Buy milk, eggs, and bread")
+    4. Add note                               - - - > add note title text (example: add note shopping_list "Buy milk, eggs, and bread #home")
     5. Add birthday                           - - - > add birthday name (example: add birthday denis 12.12.2012)
     6. Add email                              - - - > add email name email_address (example: add email denis goit@mail.com)
     7. Add contact                            - - - > add name (example: add denis)
@@ -33,82 +44,191 @@ TEXT = \
     14. Remove note                           - - - > remove note title (example: remove note shopping_list)
     15. Remove address                        - - - > remove address name address (example: remove address denis)
     16. Contacts birthday                     - - - > contacts birthday days (example: contacts birthday 5)
-    17. Show all notes                        - - - > show all notes
-    18. Show all                              - - - > show all
-    19. Search note                           - - - > search note text (example: search note milk)
-    20. Search                                - - - > search text (example: search denis)
-    21. Days to birthdays                     - - - > days to birthdays name (example: days to birthdays denis)
-    22. Folder cleaner.                       - - - > clean <path> - simple file sorter
-    23. Help                                  - - - > help
-    24. Exit                                  - - - > exit
+    17. Upcoming birthdays                    - - - > upcoming birthdays days - same list, computed over the whole book at once (needs NumPy)
+    18. Birthdays by month                    - - - > birthdays by month - contacts born in each month (needs NumPy)
+    19. Ages                                  - - - > ages - contacts per 10-year age group (needs NumPy)
+    20. Turns                                 - - - > turns age [year] (example: turns 30) - who turns 30 this year (needs NumPy)
+    21. Show all notes                        - - - > show all notes
+    22. Show all                              - - - > show all
+    23. Show duplicates                       - - - > show duplicates - phone numbers shared by several contacts
+    24. Search note                           - - - > search note text (example: search note milk)
+    25. Search tags                           - - - > search tags tag [tag ...] | tag or tag (example: search tags #home or #work)
+    26. Search                                - - - > search text (example: search denis)
+    27. Find                                  - - - > find name_or_phone (example: find +38 050 123 45 67)
+    28. Days to birthdays                     - - - > days to birthdays name (example: days to birthdays denis)
+    29. Folder cleaner.                       - - - > clean <path> [--dry-run] - simple file sorter
+    30. Import contacts                       - - - > import <path> - CSV (name,phones,birthday) or JSONL file
+    31. Export contacts                       - - - > export <path> - CSV or JSONL file, chosen by extension
+    32. Save stats                            - - - > save stats - bytes written by the autosave flushes
+    33. Stats                                 - - - > stats [prometheus [path]] - search cache hits, command latencies and errors (start with --metrics)
+    34. Help                                  - - - > help
+    35. Exit                                  - - - > exit
     """
 
 
-class ConsoleInterface(ABC):
-    @abstractclassmethod
+ERROR_MESSAGES = (
+    (KeyError, '\n  There is no contact with this name!\n'),
+    (ValueError, '\n  Check the phone number! Should be 10 digits\n'),
+    (IndexError, '\n  Check your input!\n'),
+    (FileNotFoundError, '\n  Path is not exist!\n'),
+    (AddressIsExist, '\n  Address is exist!\n'),
+    (AddressIsNotExist, '\n  Address is not exist!\n'),
+    (AttributeError, '\n  Check your input!\n'),
+)
+INPUT_ERRORS = tuple(error for error, _ in ERROR_MESSAGES)
+
+
+class ContactsInterface(ABC):
+    @abstractmethod
     def display_contacts(self, contacts):
         pass
 
-    @abstractclassmethod
+
+class NotesInterface(ABC):
+    @abstractmethod
     def display_notes(self, notes):
         pass
 
 
-
-class ContactsConsole(ConsoleInterface):
+class ContactsConsole(ContactsInterface):
     def display_contacts(self, contacts):
         print("Contacts:")
         for contact in contacts:
             print(contact)
 
 
-class NotesConsole(ConsoleInterface):
+class NotesConsole(NotesInterface):
     def display_notes(self, notes):
         print("Notes:")
         for note in notes:
             print(note)
 
+class CommandTrie:
+    # word-level trie over the command names, so "remove address" wins over
+    # "remove" no matter the order the commands were declared in
+    TOKEN = re.compile(r'"([^"]*)"|\'([^\']*)\'|(\S+)')
+
+    def __init__(self, commands):
+        self.root = {}
+        for command, handler in commands.items():
+            node = self.root
+            for word in command.split():
+                node = node.setdefault(word, {})
+            node[None] = handler
+
+    @classmethod
+    def tokenize(cls, text):
+        return [match.group(match.lastindex) for match in cls.TOKEN.finditer(text)]
+
+    def match(self, tokens):
+        node = self.root
+        handler, length = None, 0
+        for depth, token in enumerate(tokens, start=1):
+            node = node.get(token)
+            if node is None:
+                break
+            if None in node:
+                handler, length = node[None], depth
+        return handler, length
+
+
+# handlers that run without waiting for the books to load: they never read
+# them, or, like good_bye, wait on their own
+BOOKLESS = {'parser', 'help', 'clean', 'good_bye'}
+
+
+class BookLoader:
+    # runs a book's load in a background thread; wait() blocks until it is
+    # done and raises whatever the load raised
+    def __init__(self, load, *args):
+        self.error = None
+        self.thread = threading.Thread(target=self.run, args=(load, *args), name='book loader', daemon=True)
+        self.thread.start()
+
+    def run(self, load, *args):
+        try:
+            load(*args)
+        except BaseException as e:
+            self.error = e
+
+    def wait(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
 class Bot:
     def __init__(self):
         self.file = 'phone_book.pickle'
-        self.book = AddressBook()
+        self._book = AddressBook()
         self.raw_path = ""
-        try:
-            with open(self.file, 'rb') as fh:
-                read_book = pickle.load(fh)
-                self.book.data = read_book
-        except FileNotFoundError:
-            print('New phone book has been created\n')
+        self.store = JournaledStore('phone_book', self._book, Record.to_dict, Record.from_dict,
+                                    codec=RecordCodec(Record.to_packed, Record.from_packed))
+        self.book_loader = self.open_store(self.store, self._book, self.file, 'New phone book has been created\n')
 
         self.file_note = 'note_book.pickle'
-        self.notes = Note()
-
-        try:
-            with open(self.file_note, 'rb') as fh:
-                read_note = pickle.load(fh)
-                self.notes.data = read_note
-
-        except FileNotFoundError:
-            print('New book of notes has been created\n')
+        self._notes = Note()
+        self.note_store = JournaledStore('note_book', self._notes, str, str)
+        self.note_loader = self.open_store(self.note_store, self._notes, self.file_note,
+                                           'New book of notes has been created\n')
+        self.autosaver = None
+        # built by the first analytics command
+        self.birthday_columns = None
+        self.commands = CommandTrie(self.command_table())
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # changes to both books are applied and journaled together
+        with self.book.transaction(), self.notes.transaction():
+            yield
+
+    @property
+    def book(self):
+        if self.book_loader is not None:
+            self.book_loader.wait()
+            self.book_loader = None
+        return self._book
+
+    @property
+    def notes(self):
+        if self.note_loader is not None:
+            self.note_loader.wait()
+            self.note_loader = None
+        return self._notes
+
+    def open_store(self, store, book, pickle_file, new_message):
+        # an existing book is loaded in the background, so the prompt does
+        # not wait for it; the first command that uses it does
+        if not store.exists() and not os.path.exists(pickle_file):
+            print(new_message)
+            store.attach()
+            return None
+        return BookLoader(self.load_store, store, book, pickle_file)
+
+    def load_store(self, store, book, pickle_file):
+        if store.exists():
+            store.load()
+        else:
+            # books saved by older versions are migrated into the journal once
+            with open(pickle_file, 'rb') as fh:
+                book.update(pickle.load(fh))
+            store.compact()
+        store.attach()
 
     def input_error(func):
-        def inner(*args, **kwargs):
+        @functools.wraps(func)
+        def inner(self, *args, **kwargs):
+            # a command that fails halfway leaves both books as they were
+            context = contextlib.nullcontext() if func.__name__ in BOOKLESS else self.transaction()
             try:
-                return func(*args, **kwargs)
-            except KeyError:
-                return ('\n  There is no contact with this name!\n')
-            except ValueError:
-                return ('\n  Check the phone number! Should be 10 digits\n')
-            except IndexError:
-                return ('\n  Check your input!\n')
-            except FileNotFoundError:
-                return ('\n  Path is not exist!\n')
-            except AddressIsExist:
-                return ('\n  Address is exist!\n')
-            except AddressIsNotExist:
-                return ('\n  Address is not exist!\n')
-            except AttributeError:
-                return ('\n  Check your input!\n')
+                with context:
+                    return func(self, *args, **kwargs)
+            except INPUT_ERRORS as e:
+                if METRICS.enabled:
+                    METRICS.count('command_errors_total', command=func.__name__, error=type(e).__name__)
+                for error, message in ERROR_MESSAGES:
+                    if isinstance(e, error):
+                        return message
 
         return inner
 
@@ -137,7 +257,7 @@ class Bot:
     @input_error
     def add_contact(self, book, data):
 
-        record = Record(Name(data[0][0]))
+        record = Record(data[0][0])
         result = book.add_record(record)
         if result:
             print('\n Contact has been added \n')
@@ -148,10 +268,13 @@ class Bot:
         data = data[0]
         name = data[0]
         record = book.find(name)
-        phone = data[1]
+        phone = ' '.join(data[1:])
         result = record.add_phone(phone)
         if result:
             print('\n Phone has been added\n')
+        others = [other.name.value for other in book.search_phone(phone) if other is not record]
+        if others:
+            print(f'\n  This number also belongs to: {", ".join(others)}\n')
         return record
 
     @input_error
@@ -198,6 +321,9 @@ class Bot:
 
     def console_input(self):
         usr_input = input('> ')
+        return self.prepare_input(usr_input)
+
+    def prepare_input(self, usr_input):
         self.raw_path = usr_input
         return usr_input.lower().strip()
 
@@ -205,8 +331,8 @@ class Bot:
     def edit_name(self, book, data):
         data = data[0]
         old_name, new_name = data
-        record = book.edit_record(old_name, new_name)
-        return record
+        book.edit_record_name(old_name, new_name)
+        return book[new_name]
 
     @input_error
     def edit_phone(self, book, data):
@@ -239,45 +365,95 @@ class Bot:
         if record:
             result = record.days_to_birthday()
             return f"Days to birthday: {result}"
+        similar = book.find_similar(name, limit=1)
+        if not similar:
+            raise KeyError
+        record = similar[0]
+        return f"Did you mean {record.name.value}? Days to birthday: {record.days_to_birthday()}"
 
     @input_error
     def contacts_birthday(self, book, data):
         data = data[0]
         days = int(data[0])
-        result = []
-        for record in book.values():
-            # print(f'{days=} {record.days_to_birthday}')
-            if record.birthday:
-                if record.days_to_birthday() < days:
-                    result.append(record)
+        result = book.upcoming_birthdays(days)
         if result != []:
             return result
         else:
             return 'There are no contacts for congratulations'
 
+    def columns(self):
+        if self.birthday_columns is None:
+            # NumPy takes longer to import than the rest of the bot
+            from analytics import BirthdayColumns
+            self.birthday_columns = BirthdayColumns(self.book)
+        return self.birthday_columns
+
+    @input_error
+    def upcoming_birthdays(self, book, data):
+        result = self.columns().upcoming(int(data[0][0]))
+        return result or 'There are no contacts for congratulations'
+
+    @input_error
+    def birthdays_by_month(self, book, data):
+        counts = self.columns().per_month()
+        lines = [f'  {calendar.month_abbr[month]}: {count}' for month, count in enumerate(counts, start=1)]
+        return '\n' + '\n'.join(lines) + '\n'
+
+    @input_error
+    def ages(self, book, data):
+        buckets = self.columns().age_distribution()
+        if not buckets:
+            return '\n  No contacts with a birthday\n'
+        lines = [f'  {age}-{age + 9}: {count}' for age, count in buckets]
+        return '\n' + '\n'.join(lines) + '\n'
+
+    @input_error
+    def turns(self, book, data):
+        data = data[0]
+        age = int(data[0])
+        year = int(data[1]) if len(data) > 1 else None
+        result = self.columns().turning(age, year)
+        return result or f'\n  Nobody turns {age}\n'
+
     @input_error
     def find(self, book, data):
 
-        search = data[0]
+        search = ' '.join(data[0])
 
-        if search.isdigit():
-            phone = search
-            for name, record in book.items():
-                if record.find_phone(phone):
-                    return f'\n{record}\n'
-                else:
-                    raise KeyError
+        if search.lstrip('+').replace(' ', '').replace('-', '').isdigit():
+            result = book.search_phone(search)
+            if not result:
+                raise KeyError
+            return result
         else:
 
             result = book.find(search)
             if not result:
-                raise KeyError
+                similar = book.find_similar(search, limit=1)
+                if not similar:
+                    raise KeyError
+                return f"Did you mean {similar[0].name.value}? {similar[0]}"
             return result
 
     @input_error
     def clean(self, data=None, path=None):
-        cleaner = Cleaner(self.raw_path.strip().split()[1])
-        cleaner.clean()
+        from clean_folder import Cleaner
+        path = self.raw_path.strip().split(maxsplit=1)[1]
+        dry_run = path.endswith('--dry-run')
+        if dry_run:
+            path = path[:-len('--dry-run')].strip()
+        cleaner = Cleaner(path, dry_run=dry_run, progress=print)
+        return cleaner.clean()
+
+    @input_error
+    def import_contacts(self, book, data):
+        path = self.raw_path.strip().split(maxsplit=1)[1]
+        return import_contacts(book, path)
+
+    @input_error
+    def export_contacts(self, book, data):
+        path = self.raw_path.strip().split(maxsplit=1)[1]
+        return export_contacts(book, path)
 
     def hello(self, book, data):
         return '\n  Hello how can I help you?\n'
@@ -285,19 +461,21 @@ class Bot:
     def help(self, *_):
         return TEXT
 
-    @input_error
     def good_bye(self, book, data):
 
         try:
-            with open('phone_book.pickle', 'wb') as fh:
-                pickle.dump(book.data, fh)
-
-        except Exception as e:
-            return (e)
-
-        try:
-            with open('note_book.pickle', 'wb') as fh:
-                pickle.dump(self.notes.data, fh)
+            # a load that failed leaves nothing to save, so it is not raised here
+            for loader in (self.book_loader, self.note_loader):
+                if loader is not None:
+                    loader.thread.join()
+            # a batch group still open is committed before the stores close
+            for open_book in (self._book, self._notes):
+                while open_book.in_transaction:
+                    open_book.commit()
+            if self.autosaver is not None:
+                self.autosaver.stop()
+            self.store.close()
+            self.note_store.close()
         except Exception as e:
             return (e)
 
@@ -315,7 +493,6 @@ class Bot:
         else:
             phone = data[1]
             record = book.find(name)
-            book.delete(record)
             if record:
                 record.remove_phone(phone)
 
@@ -333,7 +510,11 @@ class Bot:
                 print(record)
 
         else:
-            print('\n  No results \n')
+            similar = book.find_similar(text)
+            if similar:
+                print('\n  No results. Did you mean: ' + ', '.join(r.name.value for r in similar) + '?\n')
+            else:
+                print('\n  No results \n')
 
     def show_all(self, book, data):
         if not book:
@@ -378,7 +559,7 @@ class Bot:
 
     def search_note(self, book, data):
         data = data[0]
-        request = data[0]
+        request = ' '.join(data)
         notes = self.notes
         result = notes.search(request)
         for note in result:
@@ -387,23 +568,62 @@ class Bot:
             print(f'  {title.title()}: {text}')
         return
 
+    def search_tags(self, book, data):
+        data = data[0]
+        match_all = 'or' not in data
+        tags = [tag for tag in data if tag != 'or' and tag != 'and']
+        result = self.notes.find_by_tags(tags, match_all)
+        if not result:
+            return '\n  No results \n'
+        for title, text in result:
+            print(f'  {title.title()}: {text}')
+
+    def show_duplicates(self, book, data):
+        duplicates = book.duplicate_phones()
+        if not duplicates:
+            return '\n  No shared phone numbers\n'
+        for phone, records in duplicates.items():
+            print(f'  {phone}: {", ".join(record.name.value for record in records)}')
+
+    def save_stats(self, book, data):
+        lines = []
+        for name, store in (('Contacts', self.store), ('Notes', self.note_store)):
+            metrics = store.metrics()
+            lines.append(f"  {name}: {metrics['flushes']} flushes, {metrics['bytes_written']} bytes written, "
+                         f"last {metrics['last_flush_bytes']}, average {metrics['avg_flush_bytes']}, "
+                         f"max {metrics['max_flush_bytes']} bytes per flush, {metrics['dirty']} unsaved changes")
+        return '\n' + '\n'.join(lines) + '\n'
+
+    def stats(self, book, data):
+        data = data[0]
+        caches = '\n'.join(f'  {cache.info()}' for cache in (self.book.query_cache, self.notes.query_cache))
+        if not data:
+            print('\n' + caches)
+        if not METRICS.enabled:
+            return '\n  Metrics are off, start the bot with --metrics\n'
+        if data and data[0] == 'prometheus':
+            if len(data) < 2:
+                return METRICS.prometheus()
+            with open(data[1], 'w', encoding='utf-8') as fh:
+                fh.write(METRICS.prometheus())
+            return f'\n  Metrics written to {data[1]}\n'
+        return METRICS.report()
+
     def show_all_notes(self, book, data):
         result = self.notes.print_all_notes()
         print(result)
 
     @input_error
-    def parser(self, user_input, commands):
-        for command in commands:
-            if user_input.startswith(command):
-                data = user_input.replace(command, '').split()
-                # data = user_input.split()[1:]
-                return commands[command], data
-        else:
+    def parser(self, user_input, commands=None):
+        commands = commands or self.commands
+        tokens = CommandTrie.tokenize(user_input)
+        handler, length = commands.match(tokens)
+        if handler is None:
             raise IndexError
+        return handler, tokens[length:]
 
-    def run(self):
-
-        commands = {
+    def command_table(self):
+        return {
             "add info": self.add_contact_phone_birthday_email_address,
             "add phone": self.add_phone,
             "add address": self.add_address,
@@ -421,38 +641,104 @@ class Bot:
             "remove": self.remove,
             "remove address": self.remove_address,
             'contacts birthday': self.contacts_birthday,
+            'upcoming birthdays': self.upcoming_birthdays,
+            'birthdays by month': self.birthdays_by_month,
+            'ages': self.ages,
+            'turns': self.turns,
             "clean": self.clean,  # test
+            "import": self.import_contacts,
+            "export": self.export_contacts,
             'show all notes': self.show_all_notes,
+            'show duplicates': self.show_duplicates,
             "show all": self.show_all,
             'search note': self.search_note,
+            'search tags': self.search_tags,
             "search": self.search,
+            "find": self.find,
             "days to birthdays": self.days_to_birthday,
+            'save stats': self.save_stats,
+            'stats': self.stats,
             'help': self.help,
             'exit': self.good_bye,
         }
 
+    def execute(self, user_input):
+        try:
+            function, *data = self.parser(user_input, self.commands)
+            name = getattr(function, '__name__', 'unknown')
+            book = self._book if name in BOOKLESS else self.book
+            if METRICS.enabled:
+                with METRICS.timer('command_seconds', command=name):
+                    result = function(book, data)
+            else:
+                result = function(book, data)
+
+            if result is not None:
+                if isinstance(result, list):
+                    if all(isinstance(item, Record) for item in result):
+                        ContactsConsole().display_contacts(result)
+                    elif all(isinstance(item, Note) for item in result):
+                        NotesConsole().display_notes(result)
+                else:
+                    print(result)
+
+            return result
+
+        except TypeError as e:
+            if METRICS.enabled:
+                METRICS.count('command_errors_total', command='execute', error='TypeError')
+            print('\n Check your input \n')
+        except Exception as e:
+            if METRICS.enabled:
+                METRICS.count('command_errors_total', command='execute', error=type(e).__name__)
+            print(e)
+
+    def run(self, autosave_interval=5.0, autosave_changes=500):
+        # changes are saved by a background thread instead of on every command
+        self.autosaver = Autosaver((self.store, self.note_store), autosave_interval, autosave_changes).start()
+
         print(TEXT)
 
         while True:
-            try:
-                user_input = self.console_input()
-                function, *data = self.parser(user_input, commands)
-                result = function(self.book, data)
-
-                if result is not None:
-                    if isinstance(result, list):
-                        if all(isinstance(item, Record) for item in result):
-                            ContactsConsole().display_contacts(result)
-                        elif all(isinstance(item, Note) for item in result):
-                            NotesConsole().display_notes(result)
-                    else:
-                        print(result)
-
-                if result == 'Good bye!':
+            user_input = self.console_input()
+            if self.execute(user_input) == 'Good bye!':
+                break
+
+    def run_batch(self, lines, output=None, commit_every=None):
+        # runs a script of commands as transactions of commit_every commands
+        # (or one for the whole script), each persisted with a single journal
+        # write, printing output at the end
+        output = output or sys.stdout
+        buffer = io.StringIO()
+        stores = (self.store, self.note_store)
+        books = (self.book, self.notes)
+        for store in stores:
+            store.deferred = True
+        started = time.perf_counter()
+        count = 0
+        finished = False
+        for book in books:
+            book.begin()
+        with contextlib.redirect_stdout(buffer):
+            for line in lines:
+                user_input = self.prepare_input(line.rstrip('\n'))
+                if not user_input or user_input.startswith('#'):
+                    continue
+                count += 1
+                if self.execute(user_input) == 'Good bye!':
+                    finished = True
                     break
-
-            except TypeError as e:
-                print('\n Check your input \n')
-            except Exception as e:
-                print(e)
+                if commit_every and count % commit_every == 0:
+                    for book in books:
+                        book.commit()
+                    for store in stores:
+                        store.sync()
+                    for book in books:
+                        book.begin()
+            if not finished:
+                self.good_bye(self.book, [])
+        output.write(buffer.getvalue())
+        elapsed = time.perf_counter() - started
+        rate = count / elapsed if elapsed else 0.0
+        return f'Executed {count} commands in {elapsed:.2f}s ({rate:.0f} commands/sec)'
 
@@ -0,0 +1,153 @@
+import csv
+import datetime
+import itertools
+import json
+import time
+
+from classes import Record, normalize_phone
+
+CSV_FIELDS = ('name', 'phones', 'birthday')
+
+
+class ImportReport:
+    MAX_ERRORS = 100
+
+    def __init__(self):
+        self.rows = 0
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def error(self, line, message):
+        self.failed += 1
+        # only the first errors are kept so huge broken files stay bounded
+        if len(self.errors) < self.MAX_ERRORS:
+            self.errors.append((line, message))
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.started
+        return self
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        lines = [f'\n  Imported {self.imported} of {self.rows} rows in {self.elapsed:.2f}s '
+                 f'({self.rows_per_sec:.0f} rows/sec), {self.failed} failed']
+        lines += [f'  line {line}: {message}' for line, message in self.errors]
+        if self.failed > len(self.errors):
+            lines.append(f'  ... {self.failed - len(self.errors)} more errors')
+        return '\n'.join(lines) + '\n'
+
+
+def file_format(path):
+    return 'jsonl' if path.lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def read_rows(path):
+    with open(path, newline='', encoding='utf-8') as fh:
+        if file_format(path) == 'csv':
+            # line numbers count the header, as an editor would show them
+            for line, row in enumerate(csv.DictReader(fh), start=2):
+                yield line, row
+        else:
+            for line, text in enumerate(fh, start=1):
+                if not text.strip():
+                    continue
+                try:
+                    yield line, json.loads(text)
+                except ValueError:
+                    yield line, None
+
+
+def split_phones(value):
+    if not value:
+        return []
+    if isinstance(value, str):
+        return [phone.strip() for phone in value.replace(',', ';').split(';') if phone.strip()]
+    # a number would have lost its leading zero, so only strings are accepted
+    if isinstance(value, list) and all(isinstance(phone, str) for phone in value):
+        return value
+    raise ValueError
+
+
+def validate_chunk(rows, report):
+    # the whole chunk is checked and phones normalized before any Record is
+    # built, so bad rows never touch the book
+    valid = []
+    for line, row in rows:
+        report.rows += 1
+        if not isinstance(row, dict):
+            report.error(line, 'Malformed row')
+            continue
+        name = row.get('name') or ''
+        birthday = row.get('birthday') or ''
+        if not isinstance(name, str) or not isinstance(birthday, str):
+            report.error(line, 'Name and birthday must be text')
+            continue
+        name = name.strip()
+        if not name:
+            report.error(line, 'Missing name')
+            continue
+        try:
+            phones = [normalize_phone(phone) for phone in split_phones(row.get('phones') or row.get('phone'))]
+        except ValueError:
+            report.error(line, f'Invalid phone number in {row.get("phones") or row.get("phone")}')
+            continue
+        birthday = birthday.strip() or None
+        if birthday:
+            # the same format Birthday accepts
+            try:
+                datetime.datetime.strptime(birthday, '%Y-%m-%d')
+            except ValueError:
+                report.error(line, f'Invalid birthday {birthday}')
+                continue
+        valid.append((line, {'name': name, 'phones': phones, 'birthday': birthday}))
+    return valid
+
+
+def chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def import_contacts(book, path, chunk_size=10000):
+    report = ImportReport()
+    for chunk in chunks(read_rows(path), chunk_size):
+        for line, data in validate_chunk(chunk, report):
+            try:
+                record = Record.from_dict(data)
+            except ValueError as e:
+                report.error(line, str(e))
+                continue
+            book[data['name']] = record
+            report.imported += 1
+    return report.finish()
+
+
+def export_contacts(book, path):
+    started = time.perf_counter()
+    count = 0
+    book.materialize()
+    with open(path, 'w', newline='', encoding='utf-8') as fh:
+        if file_format(path) == 'csv':
+            writer = csv.writer(fh)
+            writer.writerow(CSV_FIELDS)
+            for record in book.data.values():
+                writer.writerow((record.name.value, ';'.join(record.phone_values()),
+                                 str(record.birthday) if record.birthday else ''))
+                count += 1
+        else:
+            for record in book.data.values():
+                fh.write(json.dumps(record.to_dict(), ensure_ascii=False) + '\n')
+                count += 1
+    elapsed = time.perf_counter() - started
+    rate = count / elapsed if elapsed else 0.0
+    return f'\n  Exported {count} contacts in {elapsed:.2f}s ({rate:.0f} rows/sec)\n'
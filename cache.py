@@ -0,0 +1,46 @@
+import collections
+import threading
+
+from metrics import METRICS
+
+
+class QueryCache:
+    # bounded LRU of query results for one book. An entry keeps the book
+    # generation it was computed at and the book bumps its generation on
+    # every change, so anything cached before a change is a miss afterwards
+    def __init__(self, name, size=256):
+        self.name = name
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, generation, compute, *args):
+        with self.lock:
+            entry = self.entries.get(key)
+            hit = entry is not None and entry[0] == generation
+            if hit:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if METRICS.enabled:
+            METRICS.count('query_cache_total', cache=self.name, result='hit' if hit else 'miss')
+        if hit:
+            return list(entry[1])
+        result = compute(*args)
+        with self.lock:
+            self.entries[key] = (generation, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        # callers get their own list, so changing it never touches the cache
+        return list(result)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def info(self):
+        return f'{self.name}: {self.hits} hits, {self.misses} misses, {len(self.entries)}/{self.size} entries'
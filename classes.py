@@ -1,8 +1,59 @@
+from array import array
 from collections import UserDict
+import base64
+import bisect
+import calendar
 import datetime
+import heapq
 import json
+import re
+import sys
+import unicodedata
+
+from cache import QueryCache
+from metrics import METRICS
+from transactions import Transactional
+
+PHONE_SEPARATORS = re.compile(r'[\s\-.()/]')
+# the country code that may be typed without "+" in front of a national number
+COUNTRY_CODE = '38'
+# up to this many pending key changes are bisected into the sorted key list,
+# more are merged in one pass
+INSORT_LIMIT = 64
+
+
+def normalize_phone(value):
+    # canonical form is the 10-digit national number: separators are dropped
+    # and a country code is cut off after "+" or "00", or when it is
+    # COUNTRY_CODE; any other length is a typo, not a number
+    if not isinstance(value, str):
+        raise ValueError("Invalid phone number format")
+    digits = PHONE_SEPARATORS.sub('', value)
+    international = digits.startswith('+') or (digits.startswith('00') and len(digits) > 10)
+    if international:
+        digits = digits[1:] if digits.startswith('+') else digits[2:]
+    if not digits.isdigit():
+        raise ValueError("Invalid phone number format")
+    if international and 10 < len(digits) <= 13:
+        digits = digits[-10:]
+    elif len(digits) == 10 + len(COUNTRY_CODE) and digits.startswith(COUNTRY_CODE):
+        digits = digits[len(COUNTRY_CODE):]
+    if len(digits) != 10:
+        raise ValueError("Invalid phone number format")
+    return digits
+
+
+def canonical_phone(value):
+    # for lookups: an unparsable number cannot match anything stored anyway
+    try:
+        return normalize_phone(value)
+    except ValueError:
+        return value
+
 
 class Field:
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -12,8 +63,17 @@ class Field:
     def __str__(self):
         return str(self.value)
 
+    def __setstate__(self, state):
+        # accepts both slot state and the __dict__ of pickles made before __slots__
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **(state[1] or {})}
+        for key, value in state.items():
+            object.__setattr__(self, key, value)
+
 
 class Phone(Field):
+    __slots__ = ('_value',)
+
     def __init__(self, value):
         super().__init__(value)
         self.validate()
@@ -31,11 +91,13 @@ class Phone(Field):
 
     @value.setter
     def value(self, value):
-        self._value = value
+        self._value = normalize_phone(value)
         self.validate()
 
 
 class Birthday(Field):
+    __slots__ = ('_value',)
+
     def __init__(self, value):
         super().__init__(value)
         self.validate()
@@ -63,72 +125,526 @@ class Birthday(Field):
 
 
 
+def birthday_slot(month, day):
+    # day of a leap year, so Feb 29 birthdays get a bucket of their own
+    return datetime.date(2000, month, day).timetuple().tm_yday - 1
+
+
+def birthday_in_year(birthday, year):
+    try:
+        return datetime.date(year, birthday.month, birthday.day)
+    except ValueError:
+        # Feb 29 birthdays are celebrated on Feb 28 in common years
+        return datetime.date(year, 2, 28)
+
+
+def next_birthday(birthday, today):
+    upcoming = birthday_in_year(birthday, today.year)
+    if upcoming < today:
+        upcoming = birthday_in_year(birthday, today.year + 1)
+    return upcoming
+
+
+class NgramIndex:
+    # n-gram postings as arrays of int ids, one id per indexed key. Removing
+    # a key only retires its id; the arrays drop retired ids once they are a
+    # quarter of all ids. A query shorter than n has no gram to look up, so
+    # candidates() returns None and the caller scans instead
+    def __init__(self, n=3):
+        self.n = n
+        self.grams = {}
+        self.ids = {}
+        self.keys = []
+        self.retired = 0
+
+    def _grams(self, texts):
+        n = self.n
+        return {text[i:i + n] for text in texts for i in range(len(text) - n + 1)}
+
+    def add(self, key, *texts):
+        if key in self.ids:
+            self.remove(key)
+        id = self.ids[key] = len(self.keys)
+        self.keys.append(key)
+        for gram in self._grams(texts):
+            postings = self.grams.get(gram)
+            if postings is None:
+                postings = self.grams[gram] = array('I')
+            postings.append(id)
+
+    def remove(self, key, *texts):
+        id = self.ids.pop(key, None)
+        if id is None:
+            return
+        self.keys[id] = None
+        self.retired += 1
+        if self.retired > 1024 and self.retired * 4 > len(self.keys):
+            self._compact()
+
+    def _compact(self):
+        renumbered = array('i', [-1]) * len(self.keys)
+        keys = []
+        for id, key in enumerate(self.keys):
+            if key is not None:
+                renumbered[id] = len(keys)
+                keys.append(key)
+        for gram, postings in list(self.grams.items()):
+            live = array('I', [renumbered[id] for id in postings if renumbered[id] >= 0])
+            if live:
+                self.grams[gram] = live
+            else:
+                del self.grams[gram]
+        self.keys = keys
+        self.ids = {key: id for id, key in enumerate(keys)}
+        self.retired = 0
+
+    def candidates(self, query):
+        if len(query) < self.n:
+            return None
+        postings = []
+        for gram in self._grams((query,)):
+            ids = self.grams.get(gram)
+            if not ids:
+                return set()
+            postings.append(ids)
+        postings.sort(key=len)
+        keys = self.keys
+        ids = set(postings[0]).intersection(*postings[1:])
+        return {keys[id] for id in ids if keys[id] is not None}
+
+
+def normalize_name(name):
+    name = unicodedata.normalize('NFKD', name.lower())
+    return ' '.join(''.join(c for c in name if not unicodedata.combining(c)).split())
+
+
+def edit_distance_to(pattern):
+    # Myers' bit-parallel Levenshtein: the pattern is encoded once as bit
+    # masks, then each character of the other string costs a few int ops
+    length = len(pattern)
+    full = (1 << length) - 1
+    last = 1 << (length - 1) if length else 0
+    masks = {}
+    for i, char in enumerate(pattern):
+        masks[char] = masks.get(char, 0) | (1 << i)
+
+    def distance(text):
+        if not length:
+            return len(text)
+        positive, negative, score = full, 0, length
+        for char in text:
+            eq = masks.get(char, 0)
+            xv = eq | negative
+            xh = (((eq & positive) + positive) ^ positive) | eq
+            horizontal_positive = negative | (~(xh | positive) & full)
+            horizontal_negative = positive & xh
+            if horizontal_positive & last:
+                score += 1
+            elif horizontal_negative & last:
+                score -= 1
+            horizontal_positive = ((horizontal_positive << 1) | 1) & full
+            horizontal_negative = (horizontal_negative << 1) & full
+            positive = horizontal_negative | (~(xv | horizontal_positive) & full)
+            negative = horizontal_positive & xv
+        return score
+
+    return distance
+
+
+class BKTree:
+    # metric tree over normalized names: a query only descends into children
+    # whose edge distance is within max_distance of its distance to the node.
+    # Nodes are [word, keys, children]; removed names leave empty nodes behind
+    # because they still route searches to their children
+    def __init__(self):
+        self.root = None
+
+    def add(self, word, key):
+        if self.root is None:
+            self.root = [word, {key}, {}]
+            return
+        distance_to = edit_distance_to(word)
+        node = self.root
+        while True:
+            distance = distance_to(node[0])
+            if distance == 0:
+                node[1].add(key)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [word, {key}, {}]
+                return
+            node = child
+
+    def remove(self, word, key):
+        distance_to = edit_distance_to(word)
+        node = self.root
+        while node is not None:
+            distance = distance_to(node[0])
+            if distance == 0:
+                node[1].discard(key)
+                return
+            node = node[2].get(distance)
+
+    def search(self, word, max_distance):
+        result = []
+        distance_to = edit_distance_to(word)
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            distance = distance_to(node[0])
+            if distance <= max_distance:
+                result.extend((distance, key) for key in node[1])
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        return sorted(result)
+
+
 class Record:
+    # phones are packed as 64-bit integers in one bytes object and the birthday
+    # is a date ordinal (0 when unset); Field/Phone/Birthday objects are built
+    # on access
+    __slots__ = ('_name', '_phones', '_birthday', '_book', '_key')
+
     def __init__(self, name, birthday=None):
+        # set by AddressBook so that edits keep the book indexes in sync
+        self._book = None
+        self._key = None
+        self._phones = b''
         self.name = Field(name)
-        self.phones = []
         self.birthday = birthday
 
+    def __getstate__(self):
+        return self._name, list(self._phone_ints()), self._birthday
+
+    def __setstate__(self, state):
+        self._book = None
+        self._key = None
+        if isinstance(state, tuple) and len(state) == 3:
+            self._name, phones, self._birthday = state
+            self._phones = array('Q', phones).tobytes()
+            return
+        # pickles made before __slots__ hold the old attribute dict
+        if isinstance(state, tuple):
+            state = state[0]
+        self._name = ''
+        self._phones = b''
+        self.name = state['_name']
+        self.phones = state.get('phones', [])
+        self.birthday = state['_birthday'].value if state.get('_birthday') else None
+
+    def __str__(self):
+        birthday = f", birthday: {self.birthday}" if self.birthday else ""
+        return f"Contact name: {self._name}, phones: {'; '.join(self.phone_values())}{birthday}"
+
+    def to_dict(self):
+        return {
+            "name": self._name,
+            "phones": self.phone_values(),
+            "birthday": str(self.birthday) if self.birthday else None
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        record = cls(data["name"], data.get("birthday"))
+        record.phones = data.get("phones", ())
+        return record
+
+    # the raw slot values, as the binary snapshot stores them
+    def to_packed(self):
+        return self._name, self._phones, self._birthday
+
+    @classmethod
+    def from_packed(cls, name='', phones=b'', birthday=0):
+        # the values come from a snapshot, so they were validated when saved
+        record = cls.__new__(cls)
+        record._book = None
+        record._key = None
+        record._name = sys.intern(name)
+        record._phones = phones
+        record._birthday = birthday
+        return record
+
+    def _touch(self):
+        # called before a change, so an open transaction can save the record
+        if self._book is not None:
+            self._book._remember(self._key)
+
+    def _changed(self):
+        if self._book is not None:
+            self._book._reindex(self._key)
+
+    def _phone_ints(self):
+        return memoryview(self._phones).cast('Q')
+
+    def phone_values(self):
+        return ['%010d' % phone for phone in self._phone_ints()]
+
+    @property
+    def phones(self):
+        return [Phone(phone) for phone in self.phone_values()]
+
+    @phones.setter
+    def phones(self, phones):
+        self._touch()
+        values = [phone.value if isinstance(phone, Phone) else Phone(phone).value for phone in phones]
+        self._phones = array('Q', map(int, values)).tobytes()
+        self._changed()
 
     def add_phone(self, phone):
-        self.phones.append(Phone(phone))
+        self._touch()
+        self._phones += array('Q', [int(Phone(phone).value)]).tobytes()
+        self._changed()
 
     def find_phone(self, target_phone):
-        found_phone = next((phone for phone in self.phones if phone.value == target_phone), None)
-        return found_phone
+        target_phone = canonical_phone(target_phone)
+        if target_phone in self.phone_values():
+            return Phone(target_phone)
+        return None
 
     def remove_phone(self, phone):
-        self.phones = [p for p in self.phones if p.value != phone]
+        self._touch()
+        phone = canonical_phone(phone)
+        self._phones = array('Q', (p for p in self._phone_ints() if '%010d' % p != phone)).tobytes()
+        self._changed()
 
     def edit_phone(self, old_phone, new_phone):
-        for phone in self.phones:
-            if phone.value == old_phone:
-                phone.value = new_phone
-                return
-        raise ValueError(f"Phone number {old_phone} not found in the contact.")
+        old_phone = canonical_phone(old_phone)
+        values = self.phone_values()
+        if old_phone not in values:
+            raise ValueError(f"Phone number {old_phone} not found in the contact.")
+        self._touch()
+        phones = array('Q', self._phone_ints())
+        phones[values.index(old_phone)] = int(Phone(new_phone).value)
+        self._phones = phones.tobytes()
+        self._changed()
 
     def edit_name(self, new_name):
         self.name = Field(new_name)
 
     def search_phone(self, phone):
-        return phone in [p.value for p in self.phones]
+        return canonical_phone(phone) in self.phone_values()
 
     def days_to_birthday(self):
         if not self.birthday:
             return None
         today = datetime.date.today()
-        next_birthday = datetime.date(today.year, self.birthday.month, self.birthday.day)
-        if next_birthday < today:
-            next_birthday = next_birthday.replace(year=today.year + 1)
-        delta = next_birthday - today
+        delta = next_birthday(self.birthday, today) - today
         return delta.days
 
     @property
     def name(self):
-        return self._name.value
+        return Field(self._name)
 
     @name.setter
     def name(self, value):
-        self._name = Field(value)
+        while isinstance(value, Field):
+            value = value.value
+        self._touch()
+        self._name = sys.intern(value) if isinstance(value, str) else value
+        self._changed()
 
     @property
     def birthday(self):
-        return self._birthday.value if self._birthday else None
+        return datetime.date.fromordinal(self._birthday) if self._birthday else None
 
     @birthday.setter
     def birthday(self, value):
+        self._touch()
         if value:
-            self._birthday = Birthday(value)
+            self._birthday = Birthday(value).value.toordinal()
         else:
-            self._birthday = None
+            self._birthday = 0
+        self._changed()
 
 
-class AddressBook(UserDict):
+class AddressBook(Transactional, UserDict):
     def __init__(self, *args, **kwargs):
+        self._init_transactions()
+        self._names = NgramIndex()
+        self._phone_grams = NgramIndex()
+        self._birthdays = [set() for _ in range(366)]
+        # canonical phone -> keys, and the phones shared by several keys
+        self._phone_owners = {}
+        self._duplicates = set()
+        # built on the first fuzzy lookup, then kept in sync like the others
+        self._fuzzy = None
+        self._indexed = {}
+        # bumped by every index change, which invalidates the cached queries
+        self.generation = 0
+        self.query_cache = QueryCache('contacts')
+        self.listeners = []
+        # records still on disk, read one by one on first access
+        self._source = None
+        self._faulted = set()
+        # keys in sorted order for paging; additions and removals are applied
+        # lazily, a few by bisect and many in one merge, so bulk loads do not
+        # pay for an insort per record
+        self._sorted_keys = []
+        self._keys_added = []
+        self._keys_removed = []
         super().__init__(*args, **kwargs)
         self.page_size = 10
 
+    def __setitem__(self, key, record):
+        # a record that cannot be indexed fails here, before the book changes
+        entry = self._index_entry(record)
+        self._fault(key)
+        self._remember(key)
+        if key in self.data:
+            self._detach(key)
+        self._store(key, record, entry)
+        self._notify(key, record)
+
+    def __delitem__(self, key):
+        self._fault(key)
+        self._remember(key)
+        self._detach(key)
+        del self.data[key]
+        self._keys_removed.append(key)
+        self._notify(key, None)
+
+    def __getitem__(self, key):
+        self._fault(key)
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        self._fault(key)
+        return key in self.data
+
+    def __len__(self):
+        if self._source is None:
+            return len(self.data)
+        return len(self.data) + self._source.count - len(self._faulted)
+
+    def _store(self, key, record, entry=None):
+        if entry is None:
+            entry = self._index_entry(record)
+        if key not in self.data:
+            self._keys_added.append(key)
+        self.data[key] = record
+        record._book = self
+        record._key = key
+        self._index(key, entry)
+
+    def attach_source(self, source):
+        self._source = source
+        self._faulted = set()
+
+    def _fault(self, key):
+        if self._source is None or key in self._faulted or key in self.data:
+            return
+        record = self._source.get(key)
+        if record is not None:
+            self._faulted.add(key)
+            self._store(key, record)
+
+    @property
+    def partially_loaded(self):
+        return self._source is not None
+
+    def materialize(self):
+        if self._source is None:
+            return
+        for key, record in self._source.items():
+            if key not in self._faulted:
+                self._store(key, record)
+        self._source.close()
+        self._source = None
+        self._faulted = set()
+
+    def prepare_reads(self):
+        # loads pending records and key order now, so reads that follow do
+        # not modify the book and can safely run from several threads
+        self._ordered_keys()
+
+    def _snapshot(self, key):
+        # slot values are immutable, so saving them is enough to undo edits
+        record = self.data.get(key)
+        return None if record is None else (record, record.to_packed())
+
+    def _restore(self, undo):
+        # every touched key is dropped first: a renamed record may sit under
+        # another touched key and must not be detached after it is restored
+        for key in undo:
+            if key in self.data:
+                del self[key]
+        for key, saved in undo.items():
+            if saved is not None:
+                record, (record._name, record._phones, record._birthday) = saved
+                self[key] = record
+
+    def __getstate__(self):
+        self.materialize()
+        return {'data': self.data, 'page_size': self.page_size}
+
+    def __setstate__(self, state):
+        self.__init__(state['data'])
+        self.page_size = state['page_size']
+
+    def _detach(self, key):
+        record = self.data[key]
+        self._unindex(key)
+        if record._book is self:
+            record._book = None
+            record._key = None
+
+    @staticmethod
+    def _index_entry(record):
+        name = record.name.value.lower()
+        slot = None
+        if record.birthday:
+            slot = birthday_slot(record.birthday.month, record.birthday.day)
+        return name, set(record.phone_values()), slot
+
+    @METRICS.timed('index_update_seconds', op='add')
+    def _index(self, key, entry):
+        self.generation += 1
+        name, phones, slot = entry
+        self._names.add(key, name)
+        self._phone_grams.add(key, *phones)
+        for phone in phones:
+            owners = self._phone_owners.setdefault(phone, set())
+            owners.add(key)
+            if len(owners) > 1:
+                self._duplicates.add(phone)
+        if slot is not None:
+            self._birthdays[slot].add(key)
+        if self._fuzzy is not None:
+            self._fuzzy.add(normalize_name(name), key)
+        self._indexed[key] = entry
+
+    @METRICS.timed('index_update_seconds', op='remove')
+    def _unindex(self, key):
+        self.generation += 1
+        name, phones, slot = self._indexed.pop(key)
+        self._names.remove(key, name)
+        self._phone_grams.remove(key, *phones)
+        for phone in phones:
+            owners = self._phone_owners[phone]
+            owners.discard(key)
+            if len(owners) < 2:
+                self._duplicates.discard(phone)
+            if not owners:
+                del self._phone_owners[phone]
+        if slot is not None:
+            self._birthdays[slot].discard(key)
+        if self._fuzzy is not None:
+            self._fuzzy.remove(normalize_name(name), key)
+
+    def _reindex(self, key):
+        if key in self._indexed:
+            entry = self._index_entry(self.data[key])
+            self._unindex(key)
+            self._index(key, entry)
+            self._notify(key, self.data[key])
+
+    def _records(self, keys):
+        return [self.data[key] for key in sorted(keys)]
+
     def save_to_file(self, filename):
+        self.materialize()
         with open(filename, 'w') as file:
             json.dump(self.data, file, indent=2, default=self.json_default)
 
@@ -137,101 +653,235 @@ class AddressBook(UserDict):
             with open(filename, 'r') as file:
                 data = json.load(file)
                 for name, record_data in data.items():
-                    record = Record(name)
-                    for phone in record_data["phones"]:
-                        record.add_phone(phone)
-                    record.birthday = record_data["birthday"]
-                    self.data[name] = record
+                    self[name] = Record.from_dict(dict(record_data, name=name))
         except FileNotFoundError:
             print(f"File {filename} not found. Creating a new address book.")
-            self.data = {}
+            self.materialize()
+            for name in list(self.data):
+                del self[name]
 
     def json_default(self, obj):
         if isinstance(obj, Record):
-            return {
-                "name": obj.name.value,
-                "phones": [phone.value for phone in obj.phones],
-                "birthday": str(obj.birthday) if obj.birthday else None
-            }
+            return obj.to_dict()
         elif isinstance(obj, Field):
             return obj.value
         return None
 
     def search_contact(self, query):
-        results = []
-        for record in self.data.values():
-            # Check if the query matches any part of the phone numbers
-            for phone in record.phones:
-                if query in phone.value:
-                    results.append(record)
-                    break
-            # Check if the query matches any part of the name
-            if query.lower() in record.name.value.lower():
-                if record not in results:
-                    results.append(record)
-        return results
+        self.materialize()
+        return self.query_cache.get(('contact', query.lower()), self.generation, self._search_contact, query)
+
+    def _search_contact(self, query):
+        keys = set(self._name_matches(query.lower()))
+        digits = self._query_digits(query)
+        if digits is not None:
+            candidates = self._phone_grams.candidates(digits)
+            keys.update(key for key in (self._indexed if candidates is None else candidates)
+                        if any(digits in phone for phone in self._indexed[key][1]))
+        return self._records(keys)
+
+    @staticmethod
+    def _query_digits(query):
+        digits = PHONE_SEPARATORS.sub('', query)
+        if digits.isdigit() or digits.startswith('+'):
+            digits = canonical_phone(digits)
+        return digits if digits.isdigit() else None
+
+    def scans(self, query):
+        # whether search_contact(query) reads every contact instead of
+        # looking the query up in the n-gram indexes
+        digits = self._query_digits(query)
+        return 0 < len(query) < self._names.n or digits is not None and len(digits) < self._phone_grams.n
+
+    def _name_matches(self, text):
+        # short texts have no 3-gram, those scan the names in key order
+        if not text:
+            return ()
+        candidates = self._names.candidates(text)
+        if candidates is None:
+            candidates = self._ordered_keys()
+        return (key for key in candidates if text in self._indexed[key][0])
+
+    def search(self, query):
+        return self.search_contact(query)
 
     def add_record(self, record):
-        self.data[record.name.value] = record
+        self[record.name.value] = record
 
     def find(self, name):
-        return self.data.get(name)
+        return self.get(name)
+
+    def find_similar(self, name, max_distance=2, limit=5):
+        # contacts whose normalized name is within max_distance edits of name,
+        # closest first
+        self.materialize()
+        if self._fuzzy is None:
+            self._fuzzy = BKTree()
+            for key, (indexed_name, _, _) in self._indexed.items():
+                self._fuzzy.add(normalize_name(indexed_name), key)
+        matches = self._fuzzy.search(normalize_name(name), max_distance)
+        return [self.data[key] for _, key in matches[:limit]]
 
     def delete(self, name):
-        if name in self.data:
-            del self.data[name]
+        if name in self:
+            del self[name]
             return True
         else:
             print(f"No record found with name {name}")
             return False
 
     def remove_record(self, name):
-        del self.data[name]
+        del self[name]
 
     def search_records(self, keyword):
-        return [record for record in self.data.values() if keyword.lower() in record.name.value.lower()]
+        self.materialize()
+        keyword = keyword.lower()
+        return self._records(self._name_matches(keyword))
 
     def add_phone_to_record(self, name, phone):
-        if name in self.data:
-            self.data[name].add_phone(phone)
+        if name in self:
+            self[name].add_phone(phone)
         else:
             raise KeyError(f"No record found with name {name}")
 
     def remove_phone_from_record(self, name, phone):
-        if name in self.data:
-            self.data[name].remove_phone(phone)
+        if name in self:
+            self[name].remove_phone(phone)
         else:
             raise KeyError(f"No record found with name {name}")
 
     def edit_record_name(self, old_name, new_name):
-        if old_name in self.data:
-            record = self.data.pop(old_name)
+        if old_name in self:
+            record = self.pop(old_name)
             record.edit_name(new_name)
             self.add_record(record)
         else:
             raise KeyError(f"No record found with name {old_name}")
 
     def search_phone(self, phone):
-        return [record for record in self.data.values() if record.search_phone(phone)]
+        self.materialize()
+        phone = canonical_phone(phone)
+        return self.query_cache.get(('phone', phone), self.generation, self._search_phone, phone)
+
+    def _search_phone(self, phone):
+        return self._records(self._phone_owners.get(phone, ()))
+
+    def duplicate_phones(self):
+        # phone -> records for every number that belongs to several contacts
+        self.materialize()
+        return {phone: self._records(self._phone_owners[phone]) for phone in sorted(self._duplicates)}
+
+    def birthdays_between(self, start, end):
+        self.materialize()
+        result = []
+        day = start
+        while day <= end:
+            keys = set(self._birthdays[birthday_slot(day.month, day.day)])
+            if day.month == 2 and day.day == 28 and not calendar.isleap(day.year):
+                keys.update(self._birthdays[birthday_slot(2, 29)])
+            if keys:
+                result.append((day, self._records(keys)))
+            day += datetime.timedelta(days=1)
+        return result
+
+    def upcoming_birthdays(self, days, today=None):
+        # keyed by the day as well, so the cache rolls over with the date
+        today = today or datetime.date.today()
+        days = min(days, 366)
+        self.materialize()
+        return self.query_cache.get(('birthdays', days, today), self.generation,
+                                    self._upcoming_birthdays, days, today)
+
+    def _upcoming_birthdays(self, days, today):
+        end = today + datetime.timedelta(days=days - 1)
+        result = []
+        seen = set()
+        for _, records in self.birthdays_between(today, end):
+            for record in records:
+                if id(record) not in seen:
+                    seen.add(id(record))
+                    result.append(record)
+        return result
+
+    def keys(self):
+        self.materialize()
+        return self.data.keys()
+
+    def values(self):
+        self.materialize()
+        return self.data.values()
+
+    def items(self):
+        self.materialize()
+        return self.data.items()
+
+    def _ordered_keys(self):
+        self.materialize()
+        added, removed = self._keys_added, self._keys_removed
+        if not added and not removed:
+            return self._sorted_keys
+        keys = self._sorted_keys
+        if len(added) + len(removed) <= INSORT_LIMIT:
+            for key in removed:
+                i = bisect.bisect_left(keys, key)
+                if key not in self.data and i < len(keys) and keys[i] == key:
+                    del keys[i]
+            for key in added:
+                i = bisect.bisect_left(keys, key)
+                if key in self.data and (i == len(keys) or keys[i] != key):
+                    keys.insert(i, key)
+        else:
+            if removed:
+                keys = [key for key in keys if key in self.data]
+            added = sorted(key for key in set(added) if key in self.data)
+            merged = []
+            for key in heapq.merge(keys, added):
+                if not merged or merged[-1] != key:
+                    merged.append(key)
+            self._sorted_keys = merged
+        self._keys_added = []
+        self._keys_removed = []
+        return self._sorted_keys
+
+    @staticmethod
+    def encode_cursor(key):
+        return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            return base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        except (ValueError, UnicodeError):
+            raise ValueError(f"Invalid cursor {cursor}")
+
+    def page(self, cursor=None, page_size=None):
+        # returns a page of records in name order and the cursor of the next
+        # page (None on the last one); cursors stay valid across edits
+        page_size = page_size or self.page_size
+        if page_size < 1:
+            raise ValueError('page_size must be at least 1')
+        keys = self._ordered_keys()
+        start = 0 if cursor is None else bisect.bisect_right(keys, self.decode_cursor(cursor))
+        page_keys = keys[start:start + page_size]
+        records = [self.data[key] for key in page_keys]
+        if start + page_size >= len(keys):
+            return records, None
+        return records, self.encode_cursor(page_keys[-1])
+
+    def iterator(self, page_size=None, cursor=None):
+        while True:
+            records, cursor = self.page(cursor, page_size)
+            if records:
+                yield records
+            if cursor is None:
+                return
 
     def __iter__(self):
-        self._iter_keys = list(self.data.keys())
-        self._iter_index = 0
-        return self
-
-    def __next__(self):
-        if self._iter_index >= len(self._iter_keys):
-            raise StopIteration
-        record = self.data[self._iter_keys[self._iter_index]]
-        self._iter_index += 1
-        return record
+        for records in self.iterator():
+            yield from records
 
     def paginate(self):
-        num_pages = len(self.data) // self.page_size + (1 if len(self.data) % self.page_size > 0 else 0)
-        for page_num in range(num_pages):
-            start_index = page_num * self.page_size
-            end_index = min(start_index + self.page_size, len(self.data))
-            yield [self.data[key] for key in list(self.data.keys())[start_index:end_index]]
+        return self.iterator(self.page_size)
 
 def main():
     address_book = AddressBook()
@@ -0,0 +1,171 @@
+import concurrent.futures
+import os
+import re
+import shutil
+import sys
+import time
+
+CATEGORIES = {
+    'images': ('jpeg', 'png', 'jpg', 'svg', 'gif', 'bmp', 'webp'),
+    'video': ('avi', 'mp4', 'mov', 'mkv'),
+    'documents': ('doc', 'docx', 'txt', 'pdf', 'xlsx', 'pptx', 'odt', 'csv'),
+    'audio': ('mp3', 'ogg', 'wav', 'amr', 'flac'),
+    'archives': ('zip', 'gz', 'tar', 'tgz', 'bz2', 'xz'),
+}
+EXTENSIONS = {ext: category for category, exts in CATEGORIES.items() for ext in exts}
+
+CYRILLIC = 'абвгдеёжзийклмнопрстуфхцчшщъыьэюяєіїґ'
+LATIN = ('a', 'b', 'v', 'g', 'd', 'e', 'e', 'j', 'z', 'i', 'j', 'k', 'l', 'm', 'n', 'o', 'p', 'r', 's', 't',
+         'u', 'f', 'h', 'ts', 'ch', 'sh', 'sch', '', 'y', '', 'e', 'yu', 'ya', 'je', 'i', 'ji', 'g')
+TRANSLIT = {}
+for c, l in zip(CYRILLIC, LATIN):
+    TRANSLIT[ord(c)] = l
+    TRANSLIT[ord(c.upper())] = l.upper()
+UNSAFE = re.compile(r'[^a-zA-Z0-9_]')
+
+
+def normalize(name):
+    return UNSAFE.sub('_', name.translate(TRANSLIT))
+
+
+def split_extension(filename):
+    stem, dot, ext = filename.rpartition('.')
+    if not dot or not stem:
+        return filename, ''
+    return stem, ext
+
+
+class Cleaner:
+    # scans the folder with os.scandir in a single streaming pass and hands
+    # every move or archive extraction to a thread pool, keeping at most
+    # `window` tasks in flight so memory stays flat on huge folders
+    def __init__(self, path, dry_run=False, workers=None, progress=None, progress_every=10000):
+        self.root = os.path.abspath(path)
+        self.dry_run = dry_run
+        self.workers = workers or min(32, (os.cpu_count() or 1) * 4)
+        self.window = self.workers * 4
+        self.progress = progress
+        self.progress_every = progress_every
+        self.reserved = set()
+        self.scanned = 0
+        self.moved = 0
+        self.extracted = 0
+        self.errors = []
+        self.elapsed = 0.0
+
+    def scan(self):
+        # yields (path, category) for every file and remembers folders so
+        # the empty ones can be removed once the moves are done
+        self.folders = []
+        stack = [self.root]
+        while stack:
+            folder = stack.pop()
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if folder == self.root and entry.name in CATEGORIES:
+                            continue
+                        stack.append(entry.path)
+                        self.folders.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        self.scanned += 1
+                        category = EXTENSIONS.get(split_extension(entry.name)[1].lower())
+                        if category:
+                            yield entry.path, entry.name, category
+                        if self.progress and self.scanned % self.progress_every == 0:
+                            self.report_progress()
+
+    def destination(self, filename, category):
+        stem, ext = split_extension(filename)
+        stem = normalize(stem)
+        folder = os.path.join(self.root, category)
+        suffix = f'.{ext}' if ext else ''
+        number = 0
+        while True:
+            candidate = os.path.join(folder, f'{stem}_{number}' if number else stem)
+            # an archive extracts into a folder, but is kept as is next to it
+            # when extraction fails, so both names are taken
+            paths = (candidate, candidate + suffix) if category == 'archives' else (candidate + suffix,)
+            if not any(path in self.reserved or os.path.exists(path) for path in paths):
+                break
+            number += 1
+        self.reserved.update(paths)
+        return paths[0]
+
+    def move(self, source, target, category):
+        if self.dry_run:
+            return category
+        if category == 'archives':
+            try:
+                shutil.unpack_archive(source, target)
+                os.remove(source)
+                return 'extracted'
+            except (shutil.ReadError, ValueError, OSError):
+                # broken archives are kept, next to the extracted ones
+                shutil.rmtree(target, ignore_errors=True)
+                # destination() reserved this name along with the folder
+                target += '.' + split_extension(source)[1]
+        os.replace(source, target)
+        return category
+
+    def remove_empty_folders(self):
+        for folder in sorted(self.folders, key=len, reverse=True):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                pass
+
+    def report_progress(self):
+        elapsed = time.perf_counter() - self.started
+        rate = self.scanned / elapsed if elapsed else 0.0
+        self.progress(f'  scanned {self.scanned} files, moved {self.moved} ({rate:.0f} files/sec)')
+
+    def collect(self, done):
+        for future in done:
+            try:
+                outcome = future.result()
+            except OSError as e:
+                self.errors.append(str(e))
+                continue
+            if outcome == 'extracted':
+                self.extracted += 1
+            self.moved += 1
+
+    def clean(self):
+        if not os.path.isdir(self.root):
+            raise FileNotFoundError(self.root)
+        self.started = time.perf_counter()
+        if not self.dry_run:
+            for category in CATEGORIES:
+                os.makedirs(os.path.join(self.root, category), exist_ok=True)
+        pending = set()
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            for source, filename, category in self.scan():
+                target = self.destination(filename, category)
+                pending.add(pool.submit(self.move, source, target, category))
+                if len(pending) >= self.window:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    self.collect(done)
+            self.collect(concurrent.futures.as_completed(pending))
+        if not self.dry_run:
+            self.remove_empty_folders()
+        self.elapsed = time.perf_counter() - self.started
+        return self
+
+    def __str__(self):
+        rate = self.scanned / self.elapsed if self.elapsed else 0.0
+        action = 'would move' if self.dry_run else 'moved'
+        lines = [f'\n  Scanned {self.scanned} files, {action} {self.moved}, extracted {self.extracted} archives '
+                 f'in {self.elapsed:.2f}s ({rate:.0f} files/sec)']
+        lines += [f'  error: {error}' for error in self.errors[:20]]
+        return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    dry_run = '--dry-run' in args
+    paths = [arg for arg in args if arg != '--dry-run']
+    if len(paths) != 1:
+        print('usage: python clean_folder.py <path> [--dry-run]')
+        sys.exit(1)
+    print(Cleaner(paths[0], dry_run=dry_run, progress=print).clean())
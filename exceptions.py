@@ -0,0 +1,6 @@
+class AddressIsExist(Exception):
+    pass
+
+
+class AddressIsNotExist(Exception):
+    pass
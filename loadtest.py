@@ -0,0 +1,76 @@
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+
+
+def call(base_url, method, path, body=None):
+    data = json.dumps(body).encode('utf-8') if body is not None else None
+    req = urllib.request.Request(base_url + path, data=data, method=method,
+                                 headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(req, timeout=30) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def client(base_url, client_id, requests, write_ratio, stats, stats_lock):
+    rng = random.Random(client_id)
+    latencies = []
+    errors = 0
+    for i in range(requests):
+        started = time.perf_counter()
+        if rng.random() < write_ratio:
+            status = call(base_url, 'POST', '/contacts',
+                          {"name": f"load{client_id}_{i}", "phones": ['%010d' % rng.randrange(10 ** 10)]})
+        elif rng.random() < 0.5:
+            status = call(base_url, 'GET', f'/contacts/search?q=load{rng.randrange(100)}')
+        else:
+            status = call(base_url, 'GET', f'/contacts/birthdays?days={rng.randint(1, 30)}')
+        latencies.append(time.perf_counter() - started)
+        if status >= 400:
+            errors += 1
+    with stats_lock:
+        stats['latencies'].extend(latencies)
+        stats['errors'] += errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent load test for the ConsoleBot HTTP API')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=500, help='requests per client')
+    parser.add_argument('--write-ratio', type=float, default=0.1)
+    args = parser.parse_args()
+
+    stats = {'latencies': [], 'errors': 0}
+    stats_lock = threading.Lock()
+    threads = [threading.Thread(target=client, args=(args.url, i, args.requests, args.write_ratio, stats, stats_lock))
+               for i in range(args.clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(stats['latencies'])
+    total = len(latencies)
+    print(json.dumps({
+        "clients": args.clients,
+        "requests": total,
+        "errors": stats['errors'],
+        "seconds": round(elapsed, 2),
+        "requests_per_sec": round(total / elapsed, 1),
+        "p50_ms": round(latencies[total // 2] * 1000, 2),
+        "p99_ms": round(latencies[min(total - 1, total * 99 // 100)] * 1000, 2),
+    }))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,41 @@
-﻿from bot import Bot
+﻿import argparse
+import sys
 
-def run():
+from metrics import METRICS
+
+def run(autosave_interval=5.0, autosave_changes=500):
+    # imported here so --help does not load the whole bot
+    from bot import Bot
+    bot = Bot()
+    bot.run(autosave_interval, autosave_changes)
+
+
+def run_batch(script, commit_every=None):
+    from bot import Bot
     bot = Bot()
-    bot.run()
+    if script == '-':
+        report = bot.run_batch(sys.stdin, commit_every=commit_every)
+    else:
+        with open(script, encoding='utf-8') as fh:
+            report = bot.run_batch(fh, commit_every=commit_every)
+    print(report, file=sys.stderr)
 
 
 if __name__ == '__main__':
-    run()
+    parser = argparse.ArgumentParser(description='Console assistant bot')
+    parser.add_argument('--batch', metavar='SCRIPT', nargs='?', const='-',
+                        help='run commands from SCRIPT (or stdin) instead of the interactive prompt')
+    parser.add_argument('--commit-every', type=int, metavar='N',
+                        help='in batch mode, sync the journal every N commands instead of only at the end')
+    parser.add_argument('--autosave-interval', type=float, default=5.0, metavar='SECONDS',
+                        help='seconds between background saves of the changed contacts and notes')
+    parser.add_argument('--autosave-changes', type=int, default=500, metavar='N',
+                        help='save as soon as N changes are pending')
+    parser.add_argument('--metrics', action='store_true',
+                        help='time commands, loads, saves and index updates (see the stats command)')
+    args = parser.parse_args()
+    METRICS.enabled = args.metrics
+    if args.batch:
+        run_batch(args.batch, args.commit_every)
+    else:
+        run(args.autosave_interval, args.autosave_changes)
@@ -0,0 +1,140 @@
+import bisect
+import contextlib
+import functools
+import threading
+import time
+
+# upper bounds in seconds, from 10 microseconds to 5 seconds
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+           0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+def label_text(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+
+class Metrics:
+    # opt-in: while disabled every hook returns after one attribute check
+    def __init__(self):
+        self.enabled = False
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def timed(self, name, **labels):
+        # decorator for hot paths: costs one attribute check while disabled
+        def decorator(func):
+            @functools.wraps(func)
+            def inner(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - started, **labels)
+            return inner
+        return decorator
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def report(self):
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        lines = [f'  {"timer":<44} {"count":>8} {"mean ms":>9} {"p50 ms":>9} {"p99 ms":>9} {"max ms":>9}']
+        for (name, labels), histogram in histograms:
+            lines.append(f'  {name + label_text(labels):<44} {histogram.count:>8} {histogram.mean() * 1000:>9.3f} '
+                         f'{histogram.quantile(0.5) * 1000:>9.3f} {histogram.quantile(0.99) * 1000:>9.3f} '
+                         f'{histogram.max * 1000:>9.3f}')
+        if counters:
+            lines.append('')
+        for (name, labels), value in counters:
+            lines.append(f'  {name + label_text(labels):<44} {value:>8}')
+        return '\n' + '\n'.join(lines) + '\n'
+
+    def prometheus(self):
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        lines = []
+        declared = set()
+        for (name, labels), histogram in histograms:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f'# TYPE consolebot_{name} histogram')
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f'consolebot_{name}_bucket{label_text(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'consolebot_{name}_bucket{label_text(labels, [("le", "+Inf")])} {histogram.count}')
+            lines.append(f'consolebot_{name}_sum{label_text(labels)} {histogram.total:.9f}')
+            lines.append(f'consolebot_{name}_count{label_text(labels)} {histogram.count}')
+        for (name, labels), value in counters:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f'# TYPE consolebot_{name} counter')
+            lines.append(f'consolebot_{name}{label_text(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
@@ -0,0 +1,211 @@
+from collections import UserDict, defaultdict
+import bisect
+import heapq
+import math
+import re
+
+from cache import QueryCache
+from metrics import METRICS
+from transactions import Transactional
+
+WORD = re.compile(r'\w+')
+HASHTAG = re.compile(r'#(\w+)')
+
+
+def tokenize(text):
+    return WORD.findall(text.lower())
+
+
+def parse_tags(text):
+    return set(HASHTAG.findall(text.lower()))
+
+
+class NoteIndex:
+    # inverted index over note titles and texts, ranked with BM25; the last
+    # word of a query also matches every term it is a prefix of
+    K1 = 1.2
+    B = 0.75
+    TITLE_WEIGHT = 2
+    # a short prefix can match thousands of terms; only the first ones are scored
+    MAX_EXPANSIONS = 32
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.lengths = {}
+        self.terms = {}
+        self.total_length = 0
+        self._vocabulary = []
+        self._vocabulary_dirty = False
+
+    @METRICS.timed('note_index_seconds', op='add')
+    def add(self, title, text):
+        terms = defaultdict(int)
+        for term in tokenize(title):
+            terms[term] += self.TITLE_WEIGHT
+        for term in tokenize(text):
+            terms[term] += 1
+        for term, count in terms.items():
+            if term not in self.postings:
+                self._vocabulary_dirty = True
+            self.postings[term][title] = count
+        length = sum(terms.values())
+        self.lengths[title] = length
+        self.terms[title] = tuple(terms)
+        self.total_length += length
+
+    @METRICS.timed('note_index_seconds', op='remove')
+    def remove(self, title):
+        if title not in self.lengths:
+            return
+        self.total_length -= self.lengths.pop(title)
+        for term in self.terms.pop(title):
+            del self.postings[term][title]
+            if not self.postings[term]:
+                del self.postings[term]
+                self._vocabulary_dirty = True
+
+    def vocabulary(self):
+        if self._vocabulary_dirty:
+            self._vocabulary = sorted(self.postings)
+            self._vocabulary_dirty = False
+        return self._vocabulary
+
+    def expand(self, prefix):
+        vocabulary = self.vocabulary()
+        start = bisect.bisect_left(vocabulary, prefix)
+        end = bisect.bisect_left(vocabulary, prefix + '\uffff', start,
+                                 min(len(vocabulary), start + self.MAX_EXPANSIONS))
+        return vocabulary[start:end]
+
+    def search(self, query, limit=10):
+        words = tokenize(query)
+        if not words or not self.lengths:
+            return []
+        count = len(self.lengths)
+        average = self.total_length / count
+        scores = defaultdict(float)
+        for position, word in enumerate(words):
+            terms = self.expand(word) if position == len(words) - 1 else [word]
+            best = {}
+            for term in terms:
+                docs = self.postings.get(term, {})
+                idf = math.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5))
+                for title, tf in docs.items():
+                    norm = tf + self.K1 * (1 - self.B + self.B * self.lengths[title] / average)
+                    score = idf * tf * (self.K1 + 1) / norm
+                    if score > best.get(title, 0.0):
+                        best[title] = score
+            for title, score in best.items():
+                scores[title] += score
+        return heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+
+
+class Note(Transactional, UserDict):
+    def __init__(self, *args, **kwargs):
+        self.listeners = []
+        self._init_transactions()
+        self.index = NoteIndex()
+        # tag -> titles, kept with the tags of each note and the untagged
+        # titles so listings by tag never scan the whole notebook
+        self.tags = defaultdict(set)
+        self.note_tags = {}
+        self.untagged = set()
+        self.generation = 0
+        self.query_cache = QueryCache('notes')
+        super().__init__(*args, **kwargs)
+
+    def __setitem__(self, title, text):
+        self._remember(title)
+        self.generation += 1
+        if title in self.data:
+            self._unindex(title)
+        self.data[title] = text
+        self.index.add(title, text)
+        tags = parse_tags(text)
+        self.note_tags[title] = tags
+        for tag in tags:
+            self.tags[tag].add(title)
+        if not tags:
+            self.untagged.add(title)
+        self._notify(title, text)
+
+    def __delitem__(self, title):
+        self._remember(title)
+        self.generation += 1
+        del self.data[title]
+        self._unindex(title)
+        self._notify(title, None)
+
+    def _unindex(self, title):
+        self.index.remove(title)
+        for tag in self.note_tags.pop(title):
+            self.tags[tag].discard(title)
+            if not self.tags[tag]:
+                del self.tags[tag]
+        self.untagged.discard(title)
+
+    def __getstate__(self):
+        return {'data': self.data}
+
+    def __setstate__(self, state):
+        self.__init__(state['data'])
+
+    def _snapshot(self, title):
+        return self.data.get(title)
+
+    def _restore(self, undo):
+        for title, text in undo.items():
+            if text is not None:
+                self[title] = text
+            elif title in self.data:
+                del self[title]
+
+    def add(self, title, text):
+        self[title] = text
+        return f'Note "{title}" has been added'
+
+    def edit(self, title, new_text):
+        if title not in self.data:
+            return False
+        self[title] = new_text
+        return f'Note "{title}" has been edited'
+
+    def delete(self, title):
+        if title not in self.data:
+            return False
+        del self[title]
+        return True
+
+    def search(self, request, limit=10):
+        # ranking only looks at the words, so queries differing in case or
+        # punctuation share an entry
+        key = (' '.join(tokenize(request)), limit)
+        return self.query_cache.get(key, self.generation, self._search, request, limit)
+
+    def _search(self, request, limit):
+        return [(title, self.data[title]) for title, _ in self.index.search(request, limit)]
+
+    def find_by_tags(self, tags, match_all=True):
+        tags = [tag.lstrip('#').lower() for tag in tags]
+        titles = [self.tags.get(tag, set()) for tag in tags]
+        if not titles:
+            return []
+        if match_all:
+            found = set.intersection(*sorted(titles, key=len))
+        else:
+            found = set().union(*titles)
+        return [(title, self.data[title]) for title in sorted(found)]
+
+    def print_all_notes(self):
+        if not self.data:
+            return '\n Notebook is empty\n'
+        if not self.tags:
+            return '\n'.join(f'  {title.title()}: {text}' for title, text in self.data.items())
+        lines = []
+        for tag in sorted(self.tags):
+            lines.append(f'  #{tag}:')
+            lines += [f'    {title.title()}: {self.data[title]}' for title in sorted(self.tags[tag])]
+        if self.untagged:
+            lines.append('  Untagged:')
+            lines += [f'    {title.title()}: {self.data[title]}' for title in sorted(self.untagged)]
+        return '\n'.join(lines)
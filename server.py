@@ -0,0 +1,106 @@
+import argparse
+import asyncio
+import contextlib
+import io
+
+from bot import Bot, CommandTrie, TEXT
+
+
+class BotServer:
+    # every connection drives the same Bot, so all clients share one book.
+    # Commands run to completion on the event loop (they only touch memory),
+    # while journal fsyncs and compactions happen in a worker thread every
+    # sync_interval
+    def __init__(self, bot, sync_interval=1.0):
+        self.bot = bot
+        self.sync_interval = sync_interval
+        self.stores = (bot.store, bot.note_store)
+        self.clients = 0
+        for store in self.stores:
+            store.deferred = True
+        # commands that read or write files on the server's host: they would
+        # block the event loop and give every client the server's filesystem
+        self.local_only = {bot.clean, bot.import_contacts, bot.export_contacts}
+
+    def execute(self, line):
+        user_input = self.bot.prepare_input(line)
+        tokens = CommandTrie.tokenize(user_input)
+        handler, length = self.bot.commands.match(tokens)
+        if handler == self.bot.good_bye:
+            return None
+        args = tokens[length:]
+        if handler in self.local_only or handler == self.bot.stats and args[:1] == ['prometheus'] and len(args) > 1:
+            return '\n  This command is not available over the network\n'
+        output = io.StringIO()
+        # no other task can run until execute returns, so redirecting the
+        # process-wide stdout only captures this client's output
+        with contextlib.redirect_stdout(output):
+            self.bot.execute(user_input)
+        return output.getvalue()
+
+    async def handle(self, reader, writer):
+        self.clients += 1
+        try:
+            writer.write((TEXT + '\n> ').encode('utf-8'))
+            await writer.drain()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                output = self.execute(line.decode('utf-8', errors='replace').rstrip('\r\n'))
+                if output is None:
+                    writer.write(b'Good bye!\n')
+                    await writer.drain()
+                    break
+                writer.write((output + '> ').encode('utf-8'))
+                await writer.drain()
+        except ConnectionError:
+            # the client went away mid-write; its commands have already run
+            pass
+        finally:
+            self.clients -= 1
+            writer.close()
+
+    async def sync_periodically(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            for store in self.stores:
+                await loop.run_in_executor(None, store.sync)
+
+    async def serve(self, host=None, port=None, unix_path=None):
+        if unix_path:
+            server = await asyncio.start_unix_server(self.handle, path=unix_path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        syncer = asyncio.create_task(self.sync_periodically())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            syncer.cancel()
+
+    def close(self):
+        for store in self.stores:
+            store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the bot commands to many clients over one book')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', metavar='PATH', help='listen on a Unix socket instead of TCP')
+    parser.add_argument('--sync-interval', type=float, default=1.0, help='seconds between journal fsyncs')
+    args = parser.parse_args()
+
+    server = BotServer(Bot(), args.sync_interval)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
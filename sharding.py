@@ -0,0 +1,185 @@
+import concurrent.futures
+import datetime
+import heapq
+import itertools
+import json
+import os
+
+from classes import AddressBook, Record, normalize_name
+from storage import JournaledStore, RecordCodec, key_hash
+
+
+def shard_of(name, shards):
+    return key_hash(normalize_name(name)) % shards
+
+
+def open_shard(path):
+    book = AddressBook()
+    store = JournaledStore(path, book, Record.to_dict, Record.from_dict,
+                           codec=RecordCodec(Record.to_packed, Record.from_packed))
+    return book, store
+
+
+def snapshot_stat(path):
+    try:
+        stat = os.stat(path + '.snapshot')
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+# the per-shard part of each search, run on the owner's book or on a replica;
+# results are keys in the order the merge expects
+
+def search_keys(book, query):
+    return [record._key for record in book.search_contact(query)]
+
+
+def birthday_keys(book, start, end):
+    return [(day.toordinal(), record._key)
+            for day, records in book.birthdays_between(start, end) for record in records]
+
+
+class ShardReplica:
+    # read-only copy of one shard in a worker process, brought up to date
+    # before each query by replaying what the owner appended to the log
+    def __init__(self, path):
+        self.stat = snapshot_stat(path)
+        self.book, self.store = open_shard(path)
+        self.store.load(lazy=False, repair=False)
+        self.offset = self.store.log_offset
+
+
+replicas = {}
+
+
+def log_size(path):
+    try:
+        return os.path.getsize(path + '.log')
+    except FileNotFoundError:
+        return 0
+
+
+def replica(path):
+    current = replicas.get(path)
+    size = log_size(path)
+    # a compaction replaces the snapshot and empties the log
+    if current is None or current.stat != snapshot_stat(path) or size < current.offset:
+        current = replicas[path] = ShardReplica(path)
+    elif size > current.offset:
+        current.offset = current.store.replay_log(current.offset)
+    return current.book
+
+
+def search_replicas(paths, query):
+    return [search_keys(replica(path), query) for path in paths]
+
+
+class ShardedAddressBook:
+    # contacts split over `shards` AddressBooks by a hash of the normalized
+    # name. Every shard has its own journal files, so saving or compacting
+    # one never touches the others. With workers, searches that scan fan out
+    # to worker processes that each keep replicas of a fixed subset of the
+    # shards
+    def __init__(self, path, shards=8, workers=0):
+        self.path = path
+        meta_path = path + '.shards'
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding='utf-8') as fh:
+                stored = json.load(fh)['shards']
+            if stored != shards:
+                raise ValueError(f'{path} was created with {stored} shards, not {shards}')
+        else:
+            with open(meta_path, 'w', encoding='utf-8') as fh:
+                json.dump({'shards': shards}, fh)
+        self.paths = [f'{path}.shard{i}' for i in range(shards)]
+        self.shards = []
+        self.stores = []
+        for shard_path in self.paths:
+            book, store = open_shard(shard_path)
+            if store.exists():
+                store.load()
+            store.attach()
+            self.shards.append(book)
+            self.stores.append(store)
+        # one single-process pool per worker, so a shard always goes to the
+        # same process and is loaded there only once
+        self.pools = [concurrent.futures.ProcessPoolExecutor(1) for _ in range(workers)]
+
+    def shard(self, key):
+        return self.shards[shard_of(key, len(self.shards))]
+
+    def __setitem__(self, key, record):
+        self.shard(key)[key] = record
+
+    def __getitem__(self, key):
+        return self.shard(key)[key]
+
+    def __delitem__(self, key):
+        del self.shard(key)[key]
+
+    def __contains__(self, key):
+        return key in self.shard(key)
+
+    def __len__(self):
+        return sum(len(book) for book in self.shards)
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(book.keys() for book in self.shards)
+
+    def add_record(self, record):
+        self[record.name.value] = record
+
+    def find(self, name):
+        return self.shard(name).get(name)
+
+    def delete(self, name):
+        return self.shard(name).delete(name)
+
+    def fan_out(self, local, remote, *args, scan=False):
+        # per-shard results, computed here or in the worker processes. Only a
+        # scan is worth a round trip to the workers; an index lookup is faster
+        # in-process. Each worker gets one task covering all of its shards
+        if not self.pools or not scan:
+            return [local(book, *args) for book in self.shards]
+        for store in self.stores:
+            store.flush()
+        workers = len(self.pools)
+        futures = [pool.submit(remote, self.paths[i::workers], *args) for i, pool in enumerate(self.pools)]
+        results = [None] * len(self.shards)
+        for i, future in enumerate(futures):
+            results[i::workers] = future.result()
+        return results
+
+    def search_contact(self, query):
+        results = self.fan_out(search_keys, search_replicas, query, scan=self.shards[0].scans(query))
+        merged = heapq.merge(*([(key, i) for key in keys] for i, keys in enumerate(results)))
+        return [self.shards[i][key] for key, i in merged]
+
+    def search(self, query):
+        return self.search_contact(query)
+
+    def upcoming_birthdays(self, days, today=None):
+        today = today or datetime.date.today()
+        end = today + datetime.timedelta(days=min(days, 366) - 1)
+        # the birthday buckets make this an index lookup on every shard
+        results = [birthday_keys(book, today, end) for book in self.shards]
+        merged = heapq.merge(*([(day, key, i) for day, key in keys] for i, keys in enumerate(results)))
+        result = []
+        seen = set()
+        for _, key, i in merged:
+            if (key, i) not in seen:
+                seen.add((key, i))
+                result.append(self.shards[i][key])
+        return result
+
+    def compact(self):
+        for store in self.stores:
+            store.compact()
+
+    def close(self):
+        for pool in self.pools:
+            pool.shutdown()
+        self.pools = []
+        for store in self.stores:
+            store.close()
@@ -0,0 +1,597 @@
+from array import array
+import atexit
+import contextlib
+import gc
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+
+from metrics import METRICS
+
+# snapshot layout: a header naming the codec and its schema, then records
+# framed by a 32-bit length; version 1 snapshots were plain JSON lines
+SNAPSHOT_MAGIC = b'CBSN'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct('<4sHI')  # magic, version, schema length
+FRAME = struct.Struct('<I')
+# a string field equal to the record key is stored as this length marker
+SAME_AS_KEY = 0xFFFF
+
+
+@contextlib.contextmanager
+def paused_gc():
+    # bulk loads and saves allocate millions of objects that all stay alive;
+    # the collector would rescan them again and again for nothing
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def key_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def swap_u64(packed):
+    values = array('Q', packed)
+    values.byteswap()
+    return values.tobytes()
+
+
+# u64 arrays are kept in native order in memory and little-endian on disk
+little_endian = bytes if sys.byteorder == 'little' else swap_u64
+
+
+class JsonCodec:
+    # records as JSON [key, value] payloads, for books of plain values
+
+    def __init__(self, encode, decode):
+        self.to_json = encode
+        self.from_json = decode
+
+    def schema(self):
+        return {'codec': 'json'}
+
+    def encode(self, key, value):
+        return json.dumps([key, self.to_json(value)], separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+    def decoder(self, schema):
+        if schema.get('codec') != 'json':
+            raise ValueError('Snapshot was written by another codec')
+
+        def decode(payload):
+            key, value = json.loads(payload)
+            return key, self.from_json(value)
+
+        return decode
+
+
+class PackedCodec:
+    # records as binary fields described by a schema of (name, type) pairs.
+    # Each record starts with one fixed struct holding the key length, the
+    # i32 values and the lengths of the variable fields, whose bytes follow.
+    # The schema is saved in the snapshot header, so a snapshot written with
+    # another field list is still read: unknown fields are skipped and missing
+    # ones get the defaults of `unpack`
+    TYPES = {'str': 'H', 'u64[]': 'H', 'i32': 'i'}
+
+    def __init__(self, fields, pack, unpack):
+        self.fields = tuple(tuple(field) for field in fields)
+        self.pack = pack
+        self.unpack = unpack
+        self.head = self.head_struct(self.fields)
+        self.kinds = [kind for _, kind in self.fields]
+
+    @classmethod
+    def head_struct(cls, fields):
+        return struct.Struct('<H' + ''.join(cls.TYPES[kind] for _, kind in fields))
+
+    def schema(self):
+        return {'codec': 'packed', 'fields': [list(field) for field in self.fields]}
+
+    def encode(self, key, value):
+        encoded_key = key.encode('utf-8')
+        head = [len(encoded_key)]
+        parts = [None, encoded_key]
+        for kind, item in zip(self.kinds, self.pack(value)):
+            if kind == 'i32':
+                head.append(item)
+            elif kind == 'u64[]':
+                head.append(len(item) // 8)
+                parts.append(little_endian(item))
+            elif item == key:
+                head.append(SAME_AS_KEY)
+            else:
+                item = item.encode('utf-8')
+                head.append(len(item))
+                parts.append(item)
+        parts[0] = self.head.pack(*head)
+        return b''.join(parts)
+
+    def decoder(self, schema):
+        if schema.get('codec') != 'packed':
+            raise ValueError('Snapshot was written by another codec')
+        fields = [tuple(field) for field in schema['fields']]
+        if any(kind not in self.TYPES for _, kind in fields):
+            raise ValueError('Snapshot uses field types this version cannot read')
+        head = self.head_struct(fields)
+        kinds = [kind for _, kind in fields]
+        names = [name for name, _ in fields]
+        known = {name for name, _ in self.fields}
+        positional = fields == list(self.fields)
+        unpack = self.unpack
+
+        def decode(payload):
+            sizes = head.unpack_from(payload, 0)
+            position = head.size + sizes[0]
+            key = payload[head.size:position].decode('utf-8')
+            values = []
+            for kind, size in zip(kinds, sizes[1:]):
+                if kind == 'i32':
+                    values.append(size)
+                elif kind == 'u64[]':
+                    values.append(little_endian(payload[position:position + size * 8]))
+                    position += size * 8
+                elif size == SAME_AS_KEY:
+                    values.append(key)
+                else:
+                    values.append(payload[position:position + size].decode('utf-8'))
+                    position += size
+            if positional:
+                return key, unpack(*values)
+            return key, unpack(**{name: value for name, value in zip(names, values) if name in known})
+
+        return decode
+
+
+class RecordCodec(PackedCodec):
+    # the contact layout, with the current schema encoded and decoded
+    # without the per-field loop; older snapshots go through PackedCodec
+    FIELDS = (('name', 'str'), ('phones', 'u64[]'), ('birthday', 'i32'))
+
+    def __init__(self, pack, unpack):
+        super().__init__(self.FIELDS, pack, unpack)
+
+    def encode(self, key, value):
+        name, phones, birthday = self.pack(value)
+        encoded_key = key.encode('utf-8')
+        if name == key:
+            return self.head.pack(len(encoded_key), SAME_AS_KEY, len(phones) // 8, birthday) + \
+                encoded_key + little_endian(phones)
+        name = name.encode('utf-8')
+        return self.head.pack(len(encoded_key), len(name), len(phones) // 8, birthday) + \
+            encoded_key + name + little_endian(phones)
+
+    def decoder(self, schema):
+        if schema != self.schema():
+            return super().decoder(schema)
+        unpack_head = self.head.unpack_from
+        start = self.head.size
+        unpack = self.unpack
+
+        def decode(payload):
+            key_length, name_length, count, birthday = unpack_head(payload, 0)
+            position = start + key_length
+            key = payload[start:position].decode('utf-8')
+            if name_length == SAME_AS_KEY:
+                name = key
+            else:
+                name = payload[position:position + name_length].decode('utf-8')
+                position += name_length
+            return key, unpack(name, little_endian(payload[position:position + count * 8]), birthday)
+
+        return decode
+
+
+def read_header(buffer):
+    # returns the schema and the offset of the first record, or None for a
+    # version 1 (JSON lines) snapshot
+    if buffer[:4] != SNAPSHOT_MAGIC:
+        return None
+    magic, version, length = SNAPSHOT_HEADER.unpack_from(buffer, 0)
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f'Unknown snapshot version {version}')
+    start = SNAPSHOT_HEADER.size
+    return json.loads(bytes(buffer[start:start + length])), start + length
+
+
+def frames(buffer, position):
+    size = len(buffer)
+    while position < size:
+        (length,) = FRAME.unpack_from(buffer, position)
+        position += FRAME.size
+        yield buffer[position:position + length]
+        position += length
+
+
+class SnapshotReader:
+    # offset index over a snapshot: a header and fixed-size entries sorted by
+    # key hash, so a record is found by binary search over the mmapped index
+    MAGIC = b'CBIX'
+    HEADER = struct.Struct('<4sIQQ')  # magic, version, record count, snapshot size
+    ENTRY = struct.Struct('<QQI')  # key hash, offset, length
+    VERSION = 2
+
+    def __init__(self, snapshot_path, index_path, codec):
+        self.snapshot = open(snapshot_path, 'rb')
+        self.index = open(index_path, 'rb')
+        self.data_map = None
+        self.index_map = None
+        try:
+            header = self.index.read(self.HEADER.size)
+            magic, version, self.count, size = self.HEADER.unpack(header)
+            if magic != self.MAGIC or version != self.VERSION:
+                raise ValueError('Unknown snapshot index format')
+            if size != os.fstat(self.snapshot.fileno()).st_size:
+                raise ValueError('Snapshot index is out of date')
+            if self.count:
+                self.data_map = mmap.mmap(self.snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+                self.index_map = mmap.mmap(self.index.fileno(), 0, access=mmap.ACCESS_READ)
+                header = read_header(self.data_map)
+                if header is None:
+                    raise ValueError('Snapshot has no header')
+                schema, self.start = header
+                self.decode = codec.decoder(schema)
+        except (ValueError, struct.error):
+            self.close()
+            raise ValueError('Snapshot index is unusable')
+
+    @classmethod
+    def write_index(cls, index_path, entries, snapshot_size):
+        entries.sort()
+        with open(index_path, 'wb') as fh:
+            fh.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, len(entries), snapshot_size))
+            fh.write(b''.join(itertools.starmap(cls.ENTRY.pack, entries)))
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def _entry(self, position):
+        return self.ENTRY.unpack_from(self.index_map, self.HEADER.size + position * self.ENTRY.size)
+
+    def get(self, key):
+        if not self.count:
+            return None
+        target = key_hash(key)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle)[0] < target:
+                low = middle + 1
+            else:
+                high = middle
+        while low < self.count:
+            hashed, offset, length = self._entry(low)
+            if hashed != target:
+                break
+            stored_key, value = self.decode(self.data_map[offset:offset + length])
+            if stored_key == key:
+                return value
+            low += 1
+        return None
+
+    def items(self):
+        if not self.count:
+            return
+        for payload in frames(self.data_map, self.start):
+            yield self.decode(payload)
+
+    def close(self):
+        for handle in (self.data_map, self.index_map, self.snapshot, self.index):
+            if handle is not None:
+                handle.close()
+
+
+class JournaledStore:
+    # snapshot + append-only log of put/del records; the log is fsynced every
+    # sync_every records and folded into a new snapshot every compact_every
+
+    def __init__(self, path, book, encode, decode, sync_every=64, compact_every=10000, codec=None):
+        self.snapshot_path = path + '.snapshot'
+        self.index_path = path + '.index'
+        self.log_path = path + '.log'
+        self.name = os.path.basename(path)
+        self.book = book
+        # encode/decode turn values into JSON for the log; the codec writes
+        # the snapshot, as JSON payloads unless a binary one is given
+        self.encode = encode
+        self.decode = decode
+        self.codec = codec or JsonCodec(encode, decode)
+        self.sync_every = sync_every
+        self.compact_every = compact_every
+        self.log = None
+        self.log_records = 0
+        self.unsynced = 0
+        # key -> encoded latest value (None once removed) of the records
+        # changed since the last flush, so a record edited many times is
+        # written once. The value is encoded when the change is published: a
+        # saver thread must not read a live record that a transaction is
+        # changing
+        self.dirty = {}
+        self.dirty_lock = threading.Lock()
+        # serializes flushes and compactions, which may come from a saver thread
+        self.flush_lock = threading.RLock()
+        # while deferred, changes stay dirty until flush() or sync(), and a
+        # compaction that falls due waits for the next sync()
+        self.deferred = False
+        self.compact_due = False
+        self.flushes = 0
+        self.bytes_written = 0
+        self.last_flush_bytes = 0
+        self.max_flush_bytes = 0
+
+    def exists(self):
+        return os.path.exists(self.snapshot_path) or os.path.exists(self.log_path)
+
+    def load(self, lazy=True, repair=True):
+        # a reader that does not own the files passes repair=False, so a
+        # torn log tail is skipped instead of truncated
+        with METRICS.timer('store_load_seconds', store=self.name):
+            if os.path.exists(self.snapshot_path) and not (lazy and self._load_lazily()):
+                self._load_snapshot()
+            self.log_offset = 0
+            if os.path.exists(self.log_path):
+                self.log_offset = self.replay_log()
+                if repair and self.log_offset != os.path.getsize(self.log_path):
+                    os.truncate(self.log_path, self.log_offset)
+
+    def replay_log(self, start=0):
+        # applies the log from byte offset start and returns the offset after
+        # the last complete record, so a reader can follow the log as it grows
+        valid_size = start
+        with open(self.log_path, 'rb') as fh:
+            fh.seek(start)
+            for line in fh:
+                try:
+                    op = json.loads(line)
+                except ValueError:
+                    # a torn last line left by a crash mid-write
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                self._replay(op)
+                valid_size += len(line)
+                self.log_records += 1
+        return valid_size
+
+    def _load_lazily(self):
+        if not hasattr(self.book, 'attach_source') or not os.path.exists(self.index_path):
+            return False
+        try:
+            self.book.attach_source(SnapshotReader(self.snapshot_path, self.index_path, self.codec))
+        except ValueError:
+            return False
+        return True
+
+    def _load_snapshot(self):
+        with open(self.snapshot_path, 'rb') as fh:
+            buffer = fh.read()
+        header = read_header(buffer)
+        if header is None:
+            # version 1 snapshots are rewritten in the current format by the
+            # next compaction
+            for line in buffer.splitlines():
+                key, value = json.loads(line)
+                self.book[key] = self.decode(value)
+            return
+        schema, start = header
+        decode = self.codec.decoder(schema)
+        with paused_gc():
+            for payload in frames(buffer, start):
+                key, value = decode(payload)
+                self.book[key] = value
+
+    def _replay(self, op):
+        if op[0] == 'put':
+            self.book[op[1]] = self.decode(op[2])
+        elif op[1] in self.book:
+            del self.book[op[1]]
+
+    def attach(self):
+        self.log = open(self.log_path, 'ab')
+        self.book.listeners.append(self.on_change)
+        if hasattr(self.book, 'commit_listeners'):
+            self.book.commit_listeners.append(self.on_commit)
+
+    def on_change(self, key, value):
+        encoded = None if value is None else self.encode(value)
+        with self.dirty_lock:
+            self.dirty[key] = encoded
+            pending = len(self.dirty)
+        # the changes of a transaction are written together by on_commit
+        if not self.deferred and not getattr(self.book, 'publishing', False):
+            self.flush()
+            if self.unsynced >= self.sync_every:
+                self.sync()
+        if self.log_records + pending >= self.compact_every:
+            if self.deferred:
+                self.compact_due = True
+            else:
+                self.compact()
+
+    def on_commit(self):
+        if not self.deferred:
+            self.flush()
+            if self.unsynced >= self.sync_every:
+                self.sync()
+
+    def flush(self):
+        # appends the dirty records to the log and returns the bytes written
+        with self.flush_lock:
+            with self.dirty_lock:
+                if not self.dirty or self.log is None:
+                    return 0
+                dirty, self.dirty = self.dirty, {}
+            return self._append(dirty)
+
+    def _append(self, dirty):
+        # callers hold flush_lock
+        with METRICS.timer('store_flush_seconds', store=self.name):
+            ops = [['del', key] if value is None else ['put', key, value]
+                   for key, value in dirty.items()]
+            data = ''.join(json.dumps(op, separators=(',', ':'), ensure_ascii=False) + '\n' for op in ops)
+            data = data.encode('utf-8')
+            self.log.write(data)
+            self.log.flush()
+        if METRICS.enabled:
+            METRICS.count('store_bytes_written_total', len(data), store=self.name)
+        self.log_records += len(ops)
+        self.unsynced += len(ops)
+        self.flushes += 1
+        self.bytes_written += len(data)
+        self.last_flush_bytes = len(data)
+        self.max_flush_bytes = max(self.max_flush_bytes, len(data))
+        return len(data)
+
+    def sync(self):
+        with self.flush_lock:
+            self.flush()
+            if self.log is not None and self.unsynced:
+                with METRICS.timer('store_fsync_seconds', store=self.name):
+                    os.fsync(self.log.fileno())
+            self.unsynced = 0
+            # a book still reading records from the old snapshot is compacted
+            # once it has loaded them all; loading here would race its owner
+            if self.compact_due and not getattr(self.book, 'partially_loaded', False):
+                self.compact_due = False
+                self.compact()
+
+    def metrics(self):
+        return {
+            'flushes': self.flushes,
+            'bytes_written': self.bytes_written,
+            'last_flush_bytes': self.last_flush_bytes,
+            'max_flush_bytes': self.max_flush_bytes,
+            'avg_flush_bytes': self.bytes_written // self.flushes if self.flushes else 0,
+            'dirty': len(self.dirty),
+        }
+
+    def compact(self):
+        # may run on a saver thread while the book changes. The snapshot
+        # covers every change made up to the copy of the items; a record
+        # changed while it is written is dirty again and its final state goes
+        # to the emptied log, which load() replays over the snapshot
+        if hasattr(self.book, 'materialize'):
+            self.book.materialize()
+        with self.flush_lock:
+            with self.dirty_lock:
+                # the unsaved changes reach the log first: until it is emptied
+                # below, a load replays the log over the new snapshot, so it
+                # has to end in the state the snapshot holds
+                dirty, self.dirty = self.dirty, {}
+                if self.log is not None:
+                    if dirty:
+                        self._append(dirty)
+                    os.fsync(self.log.fileno())
+                items = list(self.book.data.items())
+            with METRICS.timer('store_compact_seconds', store=self.name):
+                self._write_snapshot(items)
+            if self.log is not None:
+                self.log.truncate(0)
+                self.log.seek(0)
+            elif os.path.exists(self.log_path):
+                os.truncate(self.log_path, 0)
+            self.log_records = 0
+            self.unsynced = 0
+
+    def _write_snapshot(self, items):
+        tmp_path = self.snapshot_path + '.tmp'
+        entries = []
+        schema = json.dumps(self.codec.schema()).encode('utf-8')
+        encode = self.codec.encode
+        with open(tmp_path, 'wb', buffering=1 << 20) as fh, paused_gc():
+            fh.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(schema)) + schema)
+            offset = SNAPSHOT_HEADER.size + len(schema)
+            for key, value in items:
+                payload = encode(key, value)
+                fh.write(FRAME.pack(len(payload)))
+                fh.write(payload)
+                offset += FRAME.size
+                entries.append((key_hash(key), offset, len(payload)))
+                offset += len(payload)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        # the index records the snapshot size, so a crash between the two
+        # replaces leaves a stale index that load() ignores
+        SnapshotReader.write_index(self.index_path + '.tmp', entries, offset)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    def close(self):
+        if self.log is None:
+            return
+        self.sync()
+        self.log.close()
+        self.log = None
+        self.book.listeners.remove(self.on_change)
+        if hasattr(self.book, 'commit_listeners'):
+            self.book.commit_listeners.remove(self.on_commit)
+
+
+class Autosaver:
+    # flushes the dirty records of the stores from a background thread every
+    # `interval` seconds, or sooner once `max_changes` changes are pending
+    # or a compaction is due, fsyncs them and compacts; stop() makes the
+    # final flush
+    def __init__(self, stores, interval=5.0, max_changes=500):
+        self.stores = stores
+        self.interval = interval
+        self.max_changes = max_changes
+        self.changes = 0
+        self.wake = threading.Event()
+        self.stopping = False
+        self.thread = None
+        self.errors = []
+
+    def start(self):
+        for store in self.stores:
+            store.deferred = True
+            store.book.listeners.append(self.on_change)
+        self.thread = threading.Thread(target=self.loop, name='autosaver', daemon=True)
+        self.thread.start()
+        # an interrupted session still saves what was typed before
+        atexit.register(self.stop)
+        return self
+
+    def on_change(self, key, value):
+        self.changes += 1
+        # a due compaction runs on this thread too, never on the input thread
+        if self.changes >= self.max_changes or any(store.compact_due for store in self.stores):
+            self.wake.set()
+
+    def loop(self):
+        while not self.stopping:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.save()
+
+    def save(self):
+        self.changes = 0
+        for store in self.stores:
+            try:
+                store.sync()
+            except OSError as e:
+                self.errors.append(str(e))
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping = True
+        self.wake.set()
+        self.thread.join()
+        self.thread = None
+        atexit.unregister(self.stop)
+        for store in self.stores:
+            store.book.listeners.remove(self.on_change)
+            store.deferred = False
+        self.save()
+
+    def metrics(self):
+        return {store.log_path: store.metrics() for store in self.stores}
@@ -0,0 +1,139 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from classes import AddressBook, Record
+from storage import JournaledStore, RecordCodec
+
+
+def open_book(path):
+    book = AddressBook()
+    store = JournaledStore(path, book, Record.to_dict, Record.from_dict,
+                           codec=RecordCodec(Record.to_packed, Record.from_packed))
+    return book, store
+
+
+def contact(name, phone=None, birthday=None):
+    record = Record(name, birthday)
+    if phone:
+        record.add_phone(phone)
+    return record
+
+
+def contents(book):
+    return {key: record.to_dict() for key, record in book.items()}
+
+
+class JournaledStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'phone_book')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def reopen(self, lazy=True):
+        book, store = open_book(self.path)
+        store.load(lazy)
+        return book, store
+
+    def test_torn_last_line_is_skipped_and_truncated(self):
+        book, store = open_book(self.path)
+        store.attach()
+        book.add_record(contact('ann', '0501234567'))
+        book.add_record(contact('bob', '0507654321'))
+        store.close()
+        size = os.path.getsize(store.log_path)
+        with open(store.log_path, 'ab') as fh:
+            fh.write(b'["put","cid",{"name":"ci')
+
+        loaded, reloaded = self.reopen()
+        self.assertEqual(sorted(loaded.data), ['ann', 'bob'])
+        self.assertEqual(os.path.getsize(store.log_path), size)
+        # the repaired log takes new records after the last complete one
+        reloaded.attach()
+        loaded.add_record(contact('cid'))
+        reloaded.close()
+        self.assertEqual(sorted(self.reopen()[0].data), ['ann', 'bob', 'cid'])
+
+    def test_reload_after_compact(self):
+        book, store = open_book(self.path)
+        store.attach()
+        book.add_record(contact('ann', '0501234567', '1990-10-20'))
+        book.add_record(contact('bob', '0507654321'))
+        store.compact()
+        self.assertEqual(os.path.getsize(store.log_path), 0)
+        book.delete('bob')
+        book.add_record(contact('cid', '0501112233'))
+        store.close()
+
+        for lazy in (True, False):
+            loaded = self.reopen(lazy)[0]
+            self.assertEqual(contents(loaded), contents(book))
+            self.assertEqual([record.name.value for record in loaded.search_phone('050 111 22 33')], ['cid'])
+
+    def test_reload_with_stale_index(self):
+        book, store = open_book(self.path)
+        store.attach()
+        book.add_record(contact('ann', '0501234567'))
+        store.compact()
+        shutil.copy(store.index_path, store.index_path + '.old')
+        book.add_record(contact('bob', '0507654321'))
+        store.compact()
+        store.close()
+        # an index left over from the previous snapshot, as after a crash
+        # between writing the snapshot and its index
+        os.replace(store.index_path + '.old', store.index_path)
+
+        loaded = self.reopen(lazy=True)[0]
+        self.assertEqual(contents(loaded), contents(book))
+        self.assertEqual(loaded['bob'].phone_values(), ['0507654321'])
+
+    def test_crash_before_log_truncate_keeps_unsaved_changes(self):
+        book, store = open_book(self.path)
+        store.attach()
+        book.add_record(contact('ann', '0501234567'))
+        store.deferred = True
+        book['ann'].add_phone('0507654321')
+        book.add_record(contact('bob'))
+
+        def crash(*args):
+            raise OSError('crashed')
+        # the new snapshot is in place but the old log is not emptied yet
+        store.log.truncate = crash
+        with self.assertRaises(OSError):
+            store.compact()
+
+        loaded = self.reopen(lazy=False)[0]
+        self.assertEqual(contents(loaded), contents(book))
+
+    def test_rolled_back_rename_leaves_indexes_and_journal_consistent(self):
+        book, store = open_book(self.path)
+        store.attach()
+        book.add_record(contact('ann', '0501234567', '1990-10-20'))
+        book.add_record(contact('bob', '0507654321'))
+        with self.assertRaises(KeyError):
+            with book.transaction():
+                book.edit_record_name('ann', 'anna')
+                book['anna'].add_phone('0509998877')
+                raise KeyError('anna')
+
+        self.assertEqual(sorted(book.data), ['ann', 'bob'])
+        self.assertEqual(book['ann'].name.value, 'ann')
+        self.assertEqual(book['ann'].phone_values(), ['0501234567'])
+        self.assertEqual([record.name.value for record in book.search_contact('ann')], ['ann'])
+        self.assertEqual(book.search_phone('0509998877'), [])
+        self.assertEqual([record.name.value for record in book.search_phone('0501234567')], ['ann'])
+        self.assertEqual([record.name.value for record in book.upcoming_birthdays(366)], ['ann'])
+
+        with book.transaction():
+            book.edit_record_name('bob', 'rob')
+        store.close()
+        loaded = self.reopen()[0]
+        self.assertEqual(contents(loaded), contents(book))
+        self.assertEqual(sorted(loaded.data), ['ann', 'rob'])
+
+
+if __name__ == '__main__':
+    unittest.main()
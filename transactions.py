@@ -0,0 +1,84 @@
+import contextlib
+
+
+class Transactional:
+    # begin/commit/rollback for the books. The first change of a key inside a
+    # transaction saves what it held before (copy on write), and changes reach
+    # the listeners only when the outermost transaction commits, so a rolled
+    # back edit is never journaled. Inner transactions work as savepoints.
+    # A book provides _snapshot(key) and _restore(undo)
+
+    def _init_transactions(self):
+        self.commit_listeners = []
+        self.publishing = False
+        self._undo = []
+        self._pending = None
+        self._restoring = False
+
+    @property
+    def in_transaction(self):
+        return bool(self._undo)
+
+    def begin(self):
+        if not self._undo:
+            self._pending = {}
+        self._undo.append({})
+
+    def commit(self):
+        if not self._undo:
+            raise RuntimeError('No transaction to commit')
+        undo = self._undo.pop()
+        if self._undo:
+            outer = self._undo[-1]
+            for key, saved in undo.items():
+                outer.setdefault(key, saved)
+            return
+        self._publish()
+
+    def _publish(self):
+        pending, self._pending = self._pending, None
+        # listeners may hold their writes until the commit listeners run
+        self.publishing = True
+        try:
+            for key, value in pending.items():
+                self._notify(key, value)
+        finally:
+            self.publishing = False
+        for listener in self.commit_listeners:
+            listener()
+
+    def rollback(self):
+        if not self._undo:
+            raise RuntimeError('No transaction to roll back')
+        undo = self._undo.pop()
+        self._restoring = True
+        try:
+            self._restore(undo)
+        finally:
+            self._restoring = False
+        if not self._undo:
+            # the listeners never saw the changes, but a compaction on a saver
+            # thread may have read them, so the restored values are published
+            self._publish()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.begin()
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    def _remember(self, key):
+        if self._undo and not self._restoring and key not in self._undo[-1]:
+            self._undo[-1][key] = self._snapshot(key)
+
+    def _notify(self, key, value):
+        # value is None when the key has been removed
+        if self._pending is not None:
+            self._pending[key] = value
+            return
+        for listener in self.listeners:
+            listener(key, value)